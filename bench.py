@@ -0,0 +1,776 @@
+# bench.py
+"""
+Офлайн-бенчмарки synth.py без настоящей модели XTTS.
+
+Вместо TTS.api подставляется детерминированная заглушка (синус нужной длины),
+HOME уводится во временную папку — ~/Documents/Text2Voice не трогаем.
+
+    python bench.py pipeline --blocks 100          # до/после: временные WAV + pydub vs numpy в памяти
+    python bench.py workers --max 8 --speed 60     # пропускная способность от числа процессов (T2V_ENGINE=procs)
+    python bench.py split --mb 1 --cases 500       # разбиение на блоки: скорость на 1 МБ + проверка свойств
+    python bench.py longform --blocks 10 100 1000  # пиковая память от длины книги (должна быть плоской)
+    python bench.py micro                          # normalize/split/склейка/экспорт/накладные /progress и /metrics
+    python bench.py e2e --clients 4 --jobs 3       # /synthesize -> /progress под N параллельными клиентами
+    python bench.py rtf                            # real-time factor инференса на CPU (с --real — настоящая модель)
+    python bench.py --real quant --chars 2000      # T2V_CPU_MODE=fast против fp32: RTF, память, сходство звука
+    python bench.py --json out.json all            # micro + split + e2e одним прогоном
+    python bench.py compare old.json new.json      # разница двух прогонов по всем числам
+
+--real (перед командой) — настоящая модель XTTS вместо заглушки, если веса уже скачаны;
+--json FILE — сохранить результат ({"meta", "results"}) для compare; --block-len — размер блока.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import re
+import types
+import uuid
+import wave
+import random
+import argparse
+import platform
+import statistics
+import atexit
+import shutil
+import tempfile
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+STUB_SR = 24000
+STUB_CPS = 15.0        # «скорость речи» заглушки: символов на секунду аудио
+
+
+# ---- заглушка модели ----
+class _StubConfig:
+    temperature = 0.75
+    length_penalty = 1.0
+    repetition_penalty = 5.0
+    top_k = 50
+    top_p = 0.85
+    gpt_cond_len = 30
+    gpt_cond_chunk_len = 4
+    max_ref_len = 30
+    sound_norm_refs = False
+
+
+class StubXtts:
+    """
+    Повторяет нужный synth.py кусок Xtts: латенты и inference.
+    speed — символов текста в секунду «вычислений» (0 = мгновенно); время занимаем
+    активным ожиданием, чтобы заглушка грузила ядро, как настоящий инференс.
+    """
+    def __init__(self, speed: float = 0.0):
+        self.config = _StubConfig()
+        self.speed = speed
+
+    def get_conditioning_latents(self, audio_path, **kw):
+        return np.zeros((1, 32, 1024), np.float32), np.zeros((1, 512, 1), np.float32)
+
+    def inference(self, text, language, gpt_cond_latent, speaker_embedding, **kw):
+        if self.speed > 0:
+            end = time.perf_counter() + len(text) / self.speed
+            while time.perf_counter() < end:
+                pass
+        n = int(STUB_SR * len(text) / STUB_CPS)
+        t = np.arange(n, dtype=np.float32) / STUB_SR
+        f = 110.0 + (sum(map(ord, text)) % 200)
+        return {"wav": (0.5 * np.sin(2 * np.pi * f * t)).astype(np.float32)}
+
+
+class StubSynthesizer:
+    output_sample_rate = STUB_SR
+
+    def __init__(self, speed: float = 0.0):
+        self.tts_model = StubXtts(speed)
+
+    def save_wav(self, wav, path, pipe_out=None):
+        a = np.asarray(wav, dtype=np.float32)
+        a = a * (32767 / max(0.01, float(np.max(np.abs(a)))))
+        with wave.open(str(path), "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(STUB_SR)
+            w.writeframes(a.astype(np.int16).tobytes())
+
+
+class StubTTS:
+    def __init__(self, *a, **kw):
+        self.synthesizer = StubSynthesizer(float(os.environ.get("T2V_STUB_SPEED", "0")))
+
+    def tts_to_file(self, text, speaker_wav=None, language=None, file_path=None, **kw):
+        m = self.synthesizer.tts_model
+        self.synthesizer.save_wav(m.inference(text, language, None, None)["wav"], file_path)
+        return file_path
+
+
+def _install_stub():
+    # до import synth: DOCS_DIR считается от HOME при импорте, а загрузчик модели берёт TTS.api из sys.modules
+    # (дочерние процессы пула при spawn заново исполняют этот модуль — и тоже получают заглушку)
+    if os.environ.get("T2V_BENCH_REAL") == "1":
+        return
+    home = os.environ.get("T2V_BENCH_HOME")
+    if not home:
+        # своя папка — своя и уборка; пул процессов наследует T2V_BENCH_HOME и её не трогает
+        home = tempfile.mkdtemp(prefix="t2v_bench_")
+        atexit.register(shutil.rmtree, home, True)
+    home = Path(home)
+    os.environ["T2V_BENCH_HOME"] = str(home)
+    os.environ["HOME"] = os.environ["USERPROFILE"] = str(home)
+    api = types.ModuleType("TTS.api")
+    api.TTS = StubTTS
+    pkg = sys.modules.setdefault("TTS", types.ModuleType("TTS"))
+    pkg.api = api
+    sys.modules["TTS.api"] = api
+
+
+if "--real" in sys.argv:
+    os.environ["T2V_BENCH_REAL"] = "1"
+_install_stub()
+import synth  # noqa: E402
+
+
+# ---- утилиты ----
+def peak_rss_mb():
+    try:
+        import resource
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return r / (1024 * 1024) if sys.platform == "darwin" else r / 1024
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+        except Exception:
+            return None
+
+def make_voice(path: Path, sec: float = 3.0) -> Path:
+    a = (0.3 * np.sin(2 * np.pi * 220 * np.arange(int(STUB_SR * sec)) / STUB_SR) * 32767).astype(np.int16)
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(STUB_SR)
+        w.writeframes(a.tobytes())
+    return path
+
+def make_text(blocks: int, block_len: int = 360) -> str:
+    sent = "Это тестовое предложение для замера скорости синтеза речи."
+    per = max(1, block_len // (len(sent) + 1))
+    return " ".join([sent] * (blocks * per))
+
+def run_job(text: str, block_len: int = 360, pause_ms: int = 120, lang: str = "ru", **kw) -> dict:
+    voice = make_voice(synth.VOICE_DIR / "bench_voice.wav")
+    job_id = uuid.uuid4().hex      # свой чекпоинт на каждый прогон
+    synth.PROGRESS[job_id] = synth.new_progress()
+    synth.do_synth(job_id, text, lang, voice, block_len, pause_ms, **kw)
+    return synth.PROGRESS[job_id]
+
+def legacy_synth(text: str, block_len: int = 360, pause_ms: int = 120, lang: str = "ru") -> Path:
+    """
+    Прежний путь do_synth: tts_to_file во временный WAV -> AudioSegment.from_file -> final += seg.
+    """
+    from pydub import AudioSegment
+
+    blocks = synth.split_into_blocks(synth.normalize_text(text), max_len=block_len)
+    tmp_files = []
+    for i, b in enumerate(blocks, 1):
+        p = synth.TMP_DIR / f"legacy_{i:04d}.wav"
+        synth.TTS_MODEL.tts_to_file(text=b, speaker_wav=None, language=lang, file_path=str(p))
+        tmp_files.append(p)
+    final = AudioSegment.silent(duration=0)
+    pad = AudioSegment.silent(duration=pause_ms)
+    for p in tmp_files:
+        final += AudioSegment.from_file(str(p))
+        final += pad
+    out = synth.OUT_DIR / "legacy.wav"
+    final.set_frame_rate(24000).set_channels(1).export(str(out), format="wav")
+    for p in tmp_files:
+        p.unlink(missing_ok=True)
+    return out
+
+def legacy_split(txt: str, max_len: int) -> list:
+    """
+    Прежний split_into_blocks: жадно по предложениям, длинное предложение — как есть.
+    """
+    sents = [s.strip() for s in synth._SENT_SPLIT.split(txt) if s.strip()]
+    blocks, cur = [], ""
+    for s in sents:
+        if not cur:
+            cur = s
+        elif len(cur) + 1 + len(s) <= max_len:
+            cur = f"{cur} {s}"
+        else:
+            blocks.append(cur)
+            cur = s
+    if cur:
+        blocks.append(cur)
+    return blocks
+
+def make_book(size: int, seed: int = 0) -> str:
+    """
+    «Книга» заданного размера: обычные предложения, диалоги через тире, числа
+    и абзацы-простыни без единой точки.
+    """
+    rnd = random.Random(seed)
+    words = ("синтез речи голос модель текст блок пауза глава книга чтение слово "
+             "предложение звук эталон очередь процесс").split()
+    parts, n = [], 0
+    while n < size:
+        r = rnd.random()
+        k = rnd.randint(3, 20) if r < 0.9 else rnd.randint(80, 300)
+        ws = [rnd.choice(words) if rnd.random() > 0.05 else str(rnd.randint(1, 2024)) for _ in range(k)]
+        for i in range(4, len(ws) - 1, rnd.randint(4, 9)):
+            ws[i] += rnd.choice([",", ",", ";", " —"])
+        s = " ".join(ws).capitalize() + rnd.choice([".", ".", ".", "!", "?", "…"])
+        parts.append(s)
+        n += len(s) + 1
+    return " ".join(parts)
+
+def check_blocks(txt: str, blocks: list, max_len: int, lang: str) -> list:
+    """
+    Свойства разбиения; возвращает список нарушений (пустой — всё в порядке).
+    """
+    bad = []
+    if re.sub(r"\s", "", "".join(blocks)) != re.sub(r"\s", "", txt):
+        bad.append("текст потерян или переставлен")
+    if any(not b.strip() for b in blocks):
+        bad.append("пустой блок")
+    over = [len(b) for b in blocks if len(b) > max_len]
+    if over:
+        bad.append(f"длиннее max_len: {over[:3]}")
+    toks = synth.count_tokens(blocks, lang)
+    if toks and max(toks) > synth.TOKEN_LIMIT:
+        bad.append(f"больше {synth.TOKEN_LIMIT} токенов: {max(toks)}")
+    if len(synth._cuts([len(b) for b in blocks], toks, max_len, synth.TOKEN_LIMIT)) < len(blocks) - 1:
+        bad.append("соседние блоки можно склеить")
+    return bad
+
+def timeit(fn, min_sec: float = 0.5, min_calls: int = 3) -> dict:
+    """
+    Гоняет fn() не меньше min_sec и min_calls раз; время одного вызова — медиана.
+    """
+    times, t_end = [], time.perf_counter() + min_sec
+    while len(times) < min_calls or time.perf_counter() < t_end:
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {"calls": len(times), "sec": statistics.median(times), "min_sec": min(times)}
+
+def percentiles(xs: list) -> dict:
+    xs = sorted(xs)
+    if not xs:
+        return {}
+    at = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))]
+    return {"n": len(xs), "mean": sum(xs) / len(xs), "p50": at(0.50), "p95": at(0.95), "max": xs[-1]}
+
+def meta(args) -> dict:
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                             capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        rev = None
+    return {
+        "cmd": args.cmd, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "git": rev,
+        "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+        "engine": synth.ENGINE, "model": "xtts" if args.real else "stub",
+        "stub_speed": None if args.real else float(os.environ.get("T2V_STUB_SPEED", "0")),
+    }
+
+
+# ---- сценарии ----
+def _pipeline_child(mode: str, blocks: int) -> dict:
+    text = make_text(blocks)
+    synth.wait_model()
+    # кэш латентов грузит torch (а legacy — нет): импортируем заранее, чтобы не мерить импорт
+    try:
+        __import__("torch")
+    except ImportError:
+        pass
+    base = peak_rss_mb()
+    t0 = time.perf_counter()
+    if mode == "legacy":
+        legacy_synth(text)
+    else:
+        p = run_job(text)
+        if p.get("error"):
+            raise RuntimeError(p["error"])
+    peak = peak_rss_mb()
+    return {"mode": mode, "blocks": blocks, "wall_sec": time.perf_counter() - t0, "peak_rss_mb": peak,
+            "job_rss_mb": peak - base if peak is not None and base is not None else None}
+
+def bench_pipeline(args) -> dict:
+    # каждый режим — в отдельном процессе, иначе пиковый RSS общий
+    res = {}
+    for mode in ("legacy", "memory", "spill"):
+        env = dict(os.environ, T2V_BENCH_HOME="", T2V_CHECKPOINT="0", T2V_SPILL="1" if mode == "spill" else "0")
+        out = subprocess.run(
+            [sys.executable, __file__, "_pipeline_child", mode, str(args.blocks)],
+            env=env, capture_output=True, text=True,
+        )
+        if out.returncode != 0:
+            res[mode] = {"error": out.stderr.strip().splitlines()[-1:]}
+            continue
+        res[mode] = json.loads(out.stdout.strip().splitlines()[-1])
+    return res
+
+def make_chapters(blocks: int, per_chapter: int = 20) -> str:
+    out = []
+    for n in range(0, blocks, per_chapter):
+        out.append(f"Глава {n // per_chapter + 1}\n" + make_text(min(per_chapter, blocks - n)))
+    return "\n\n".join(out)
+
+def _longform_child(blocks: int, fmt: str) -> dict:
+    text = make_chapters(blocks)
+    synth.wait_model()
+    t0 = time.perf_counter()
+    p = run_job(text, fmt=fmt, longform="markers")
+    if p.get("error"):
+        raise RuntimeError(p["error"])
+    return {
+        "blocks": p["total_blocks"], "audio_hours": p["audio_sec"] / 3600, "chapters": len(p.get("chapters") or []),
+        "wall_sec": time.perf_counter() - t0, "peak_rss_mb": peak_rss_mb(),
+    }
+
+def bench_longform(args) -> dict:
+    # книга в N блоков (≈24 с речи на блок у заглушки) — каждый размер в свежем процессе
+    res = {}
+    for n in args.blocks:
+        env = dict(os.environ, T2V_BENCH_HOME="")
+        out = subprocess.run([sys.executable, __file__, "_longform_child", str(n), args.fmt],
+                             env=env, capture_output=True, text=True)
+        if out.returncode != 0:
+            res[n] = {"error": out.stderr.strip().splitlines()[-1:]}
+            continue
+        res[n] = json.loads(out.stdout.strip().splitlines()[-1])
+    return res
+
+def _workers_child(blocks: int) -> dict:
+    text = make_text(blocks)
+    synth.wait_model()          # старт процессов и прогрев — вне замера
+    t0 = time.perf_counter()
+    p = run_job(text)
+    if p.get("error"):
+        raise RuntimeError(p["error"])
+    wall = time.perf_counter() - t0
+    return {
+        "procs": synth.PROCS, "blocks": p["total_blocks"], "chars": p["total_chars"],
+        "wall_sec": wall, "blocks_per_sec": p["total_blocks"] / wall, "chars_per_sec": p["total_chars"] / wall,
+    }
+
+def bench_workers(args) -> dict:
+    # один и тот же текст на 1, 2, 4 … --max процессов; каждый прогон — свежий процесс
+    counts, n = [], 1
+    while n < args.max:
+        counts.append(n)
+        n *= 2
+    counts.append(args.max)
+    res, base = {}, None
+    for n in counts:
+        env = dict(os.environ, T2V_BENCH_HOME="", T2V_CHECKPOINT="0", T2V_ENGINE="procs", T2V_PROCS=str(n),
+                   T2V_STUB_SPEED=str(args.speed))
+        cmd = [sys.executable, __file__] + (["--real"] if args.real else []) + ["_workers_child", str(args.blocks)]
+        out = subprocess.run(cmd, env=env, capture_output=True, text=True)
+        if out.returncode != 0:
+            res[n] = {"error": out.stderr.strip().splitlines()[-1:]}
+            continue
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        base = base or r["wall_sec"]
+        r["speedup"] = base / r["wall_sec"]
+        res[n] = r
+    return {"cpu_count": os.cpu_count(), "results": res}
+
+def bench_split(args) -> dict:
+    # скорость на «книге» --mb мегабайт, затем случайные тексты и лимиты на свойства
+    txt = synth.normalize_text(make_book(int(args.mb * 1_000_000)), hard=True)
+    res = {"chars": len(txt), "max_len": args.max_len, "tokenizer": synth.xtts_tokenizer() is not None}
+
+    def stats(fn) -> dict:
+        t0 = time.perf_counter()
+        blocks = fn()
+        sec = time.perf_counter() - t0
+        lens = [len(b) for b in blocks]
+        toks = synth.count_tokens(blocks, args.lang)
+        return {
+            "sec": sec, "blocks": len(blocks), "min_len": min(lens), "mean_len": sum(lens) / len(lens),
+            "max_len": max(lens), "last_len": lens[-1], "max_tokens": max(toks),
+            "over_tokens": sum(k > synth.TOKEN_LIMIT for k in toks),
+        }
+
+    res["legacy"] = stats(lambda: legacy_split(txt, args.max_len))
+    res["new"] = stats(lambda: synth.split_into_blocks(txt, args.max_len, args.lang))
+    res["new"]["violations"] = check_blocks(txt, synth.split_into_blocks(txt, args.max_len, args.lang),
+                                            args.max_len, args.lang)
+
+    rnd = random.Random(args.seed)
+    failed = []
+    for case in range(args.cases):
+        t = synth.normalize_text(make_book(rnd.randint(0, 5000), seed=rnd.random()), hard=True)
+        ml = rnd.randint(20, 900)
+        lang = rnd.choice(["ru", "en", "zh-cn"])
+        bad = check_blocks(t, synth.split_into_blocks(t, ml, lang), ml, lang)
+        if bad:
+            failed.append({"case": case, "max_len": ml, "lang": lang, "violations": bad})
+    res["properties"] = {"cases": args.cases, "failed": failed[:10], "ok": not failed}
+    return res
+
+def bench_micro(args) -> dict:
+    # отдельные этапы без модели: текст, склейка, кодирование, накладные HTTP-опроса
+    raw = make_book(int(args.kb * 1000))
+    txt = synth.normalize_text(raw, hard=True)
+    mb = len(raw.encode("utf-8")) / 1e6
+    res = {"text_kb": args.kb}
+
+    r = timeit(lambda: synth.normalize_text(raw, hard=True))
+    res["normalize_text"] = dict(r, mb_per_sec=mb / r["sec"])
+    r = timeit(lambda: synth.split_into_blocks(txt, args.block_len, "ru"))
+    res["split_into_blocks"] = dict(r, mb_per_sec=mb / r["sec"], blocks=len(synth.split_into_blocks(txt, args.block_len, "ru")))
+
+    # ~25 с речи на блок, как у блока в 360 символов
+    rng = np.random.default_rng(0)
+    chunks = [(0.1 * rng.standard_normal(STUB_SR * 25)).astype(np.float32) for _ in range(args.blocks)]
+    audio_sec = sum(c.size for c in chunks) / STUB_SR
+    r = timeit(lambda: synth.assemble(chunks, 120))
+    res["concat"] = dict(r, blocks=args.blocks, audio_sec=audio_sec)
+
+    final = synth.assemble(chunks, 120)
+    res["export"] = {}
+    for fmt, (ext, _, _) in synth.OUT_FORMATS.items():
+        out = synth.TMP_DIR / f"bench_export.{ext}"
+
+        def export():
+            w = synth.AudioWriter(out, fmt)
+            try:
+                w.write(final)
+                w.close()
+            except Exception:
+                w.abort()
+                raise
+        try:
+            r = timeit(export, min_sec=0.0, min_calls=1)
+            res["export"][fmt] = dict(r, x_realtime=final.size / STUB_SR / r["sec"], bytes=out.stat().st_size)
+        except Exception as e:
+            res["export"][fmt] = {"error": f"{e}"}
+        out.unlink(missing_ok=True)
+
+    # /progress и /metrics через test_client: задача «на середине», как при живом опросе
+    job_id = "0" * 32
+    p = synth.new_progress()
+    p.update(total_blocks=100, done_blocks=40, total_chars=36000, chars_done=14400,
+             cur_block_len=360, cur_block_started=time.time(), status="running")
+    synth.PROGRESS[job_id] = p
+    client = synth.app.test_client()
+    for name, url in (("progress", f"/progress/{job_id}"), ("metrics", "/metrics")):
+        lat = []
+        for _ in range(args.requests):
+            t0 = time.perf_counter()
+            r = client.get(url)
+            lat.append(time.perf_counter() - t0)
+            assert r.status_code == 200, r.status_code
+        res[name] = {k: (v * 1000 if k != "n" else v) for k, v in percentiles(lat).items()}
+        res[name]["unit"] = "ms"
+    synth.PROGRESS.pop(job_id, None)
+    return res
+
+def bench_e2e(args) -> dict:
+    # N клиентов по jobs задач: POST /synthesize, затем опрос /progress до готового файла
+    make_voice(synth.VOICE_DIR / "bench_voice.wav")
+    synth.wait_model()
+
+    def client(n: int) -> dict:
+        c = synth.app.test_client()
+        lat, chars, rejected = [], 0, 0
+        for k in range(args.jobs):
+            # у каждой задачи свой текст, иначе всё отдаст кэш блоков
+            text = make_book(args.chars, seed=n * 1000 + k)
+            t0 = time.perf_counter()
+            while True:
+                r = c.post("/synthesize", headers={"X-Client-Id": f"bench-{n}"}, data={
+                    "text": text, "lang": "ru", "block": str(args.block_len), "pause": "120",
+                    "voice_choice": "bench_voice.wav",
+                })
+                if r.status_code != 429:
+                    break
+                rejected += 1
+                time.sleep(float(r.headers.get("Retry-After", "1")))
+            if r.status_code != 200:
+                raise RuntimeError(f"/synthesize {r.status_code}: {r.get_json()}")
+            job_id = r.get_json()["job_id"]
+            while True:
+                r = c.get(f"/progress/{job_id}")
+                j = r.get_json()
+                if r.status_code != 200:
+                    raise RuntimeError(j.get("error"))
+                if j.get("url"):
+                    break
+                time.sleep(args.poll)
+            lat.append(time.perf_counter() - t0)
+            chars += len(text)
+        return {"latency": lat, "chars": chars, "rejected": rejected}
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as ex:
+        per = list(ex.map(client, range(args.clients)))
+    wall = time.perf_counter() - t0
+    jobs = args.clients * args.jobs
+    chars = sum(x["chars"] for x in per)
+    return {
+        "clients": args.clients, "jobs": jobs, "chars": chars, "wall_sec": wall,
+        "jobs_per_sec": jobs / wall, "chars_per_sec": chars / wall,
+        "job_latency_sec": percentiles([t for x in per for t in x["latency"]]),
+        "rejected_429": sum(x["rejected"] for x in per),
+    }
+
+def bench_rtf(args) -> dict:
+    # real-time factor инференса (сек. вычислений / сек. аудио); с --real — настоящая XTTS на CPU
+    synth.wait_model()
+    run_job(make_book(args.chars, seed=1), block_len=args.block_len)      # прогрев латентов и ядер
+    p = run_job(make_book(args.chars, seed=2), block_len=args.block_len)
+    if p.get("error"):
+        raise RuntimeError(p["error"])
+    st = p["stages"]
+    audio = p["infer_audio_sec"]
+    try:
+        import torch
+        threads = torch.get_num_threads()
+    except ImportError:
+        threads = None
+    return {
+        "blocks": p["total_blocks"], "chars": p["total_chars"], "audio_sec": audio,
+        "infer_sec": st.get("infer", 0.0), "rtf": st.get("infer", 0.0) / audio if audio else None,
+        "stages": st, "torch_threads": threads,
+        "load_sec": synth.MODEL_STATE["load_sec"], "warmup_sec": synth.MODEL_STATE["warmup_sec"],
+    }
+
+def audio_similarity(a: np.ndarray, b: np.ndarray, sr: int = STUB_SR) -> dict:
+    """
+    Грубое сходство двух озвучек одного текста (сэмплирование XTTS случайно, поэтому
+    не по сэмплам): косинус средних лог-спектров (тембр), косинус огибающих громкости
+    на общей сетке (темп/паузы) и отношение длительностей.
+    """
+    def spec(x):
+        n, hop = 1024, 256
+        if x.size < n:
+            x = np.pad(x, (0, n - x.size))
+        frames = np.lib.stride_tricks.sliding_window_view(x, n)[::hop] * np.hanning(n)
+        return np.log1p(np.abs(np.fft.rfft(frames, axis=1)))
+
+    def cos(u, v):
+        return float(np.dot(u, v) / max(1e-9, np.linalg.norm(u) * np.linalg.norm(v)))
+
+    sa, sb = spec(a), spec(b)
+    grid = np.linspace(0, 1, 200)
+    env = [np.interp(grid, np.linspace(0, 1, len(s)), s.mean(axis=1)) for s in (sa, sb)]
+    return {
+        "spectral": cos(sa.mean(axis=0), sb.mean(axis=0)),
+        "envelope": cos(env[0] - env[0].mean(), env[1] - env[1].mean()),
+        "duration_ratio": b.size / max(1, a.size),
+    }
+
+def _quant_child(seed: int, out_dir: Path, voice: str, chars: int, block_len: int, lang: str) -> dict:
+    # режим берётся из T2V_CPU_MODE при импорте synth; блоки — прямо через модель, с фиксированным seed
+    t0 = time.perf_counter()
+    synth.wait_model()
+    load = time.perf_counter() - t0
+    vw = synth.ensure_wav_24k_mono(Path(voice)) if voice else make_voice(synth.VOICE_DIR / "bench_voice.wav")
+    gpt, spk, _ = synth.voice_latents(vw)
+    blocks = synth.split_into_blocks(synth.normalize_text(make_book(chars, seed=3), hard=True), block_len, lang)
+    try:
+        import torch
+        seed_fn = torch.manual_seed
+    except ImportError:
+        seed_fn = lambda n: None
+    synth.infer_block(blocks[0], lang, gpt, spk)          # прогрев ядер под этот режим
+    infer, audio = 0.0, 0.0
+    for i, b in enumerate(blocks):
+        seed_fn(seed + i)
+        t1 = time.perf_counter()
+        a = np.asarray(synth.infer_block(b, lang, gpt, spk), dtype=np.float32)
+        infer += time.perf_counter() - t1
+        audio += a.size / STUB_SR
+        np.save(out_dir / f"{i:04d}.npy", a)
+    return {
+        "mode": synth.CPU_MODE, "cpu": synth.MODEL_STATE.get("cpu"), "blocks": len(blocks),
+        "audio_sec": audio, "infer_sec": infer, "rtf": infer / audio if audio else None,
+        "load_sec": load, "model_mb": (synth.MODEL_STATE.get("model_bytes") or 0) / 2**20,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def bench_quant(args) -> dict:
+    """
+    fp32 против fast (int8 + inference_mode + явные потоки) на одних и тех же блоках,
+    каждый режим — свежий процесс. "fp32_reseed" — fp32 с другим seed: порог сходства,
+    ниже которого разница уже не объясняется случайностью сэмплирования.
+    """
+    runs = [("fp32", "fp32", 0), ("fast", "fast", 0)] + ([("fp32_reseed", "fp32", 1000)] if args.reseed else [])
+    root = Path(tempfile.mkdtemp(prefix="t2v_quant_"))
+    res = {}
+    for name, mode, seed in runs:
+        d = root / name
+        d.mkdir()
+        env = dict(os.environ, T2V_BENCH_HOME="", T2V_CPU_MODE=mode, T2V_BLOCK_CACHE_MB="0", T2V_CHECKPOINT="0",
+                   T2V_ENGINE="thread")
+        cmd = [sys.executable, __file__] + (["--real"] if args.real else []) + [
+            "_quant_child", str(seed), str(d), args.voice or "", str(args.chars), str(args.block_len), args.lang]
+        out = subprocess.run(cmd, env=env, capture_output=True, text=True)
+        if out.returncode != 0:
+            res[name] = {"error": out.stderr.strip().splitlines()[-1:]}
+            continue
+        res[name] = json.loads(out.stdout.strip().splitlines()[-1])
+    base = res.get("fp32", {})
+    for name, r in res.items():
+        if name == "fp32" or "error" in r or "error" in base:
+            continue
+        sims = [audio_similarity(np.load(root / "fp32" / f"{i:04d}.npy"), np.load(root / name / f"{i:04d}.npy"))
+                for i in range(min(base["blocks"], r["blocks"]))]
+        r["similarity"] = {k: statistics.fmean(x[k] for x in sims) for k in sims[0]} if sims else None
+        if base.get("rtf") and r.get("rtf"):
+            r["speedup"] = base["rtf"] / r["rtf"]
+    return res
+
+def bench_all(args) -> dict:
+    return {"micro": bench_micro(args), "split": bench_split(args), "e2e": bench_e2e(args)}
+
+def _flatten(d, prefix: str = "") -> dict:
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}.{k}" if prefix else str(k)
+        if isinstance(v, dict):
+            out.update(_flatten(v, key))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = v
+    return out
+
+def compare(old: Path, new: Path) -> dict:
+    a = _flatten(json.loads(old.read_text(encoding="utf-8")).get("results", {}))
+    b = _flatten(json.loads(new.read_text(encoding="utf-8")).get("results", {}))
+    rows = {k: {"old": a[k], "new": b[k], "ratio": b[k] / a[k] if a[k] else None} for k in a if k in b}
+    for k, r in rows.items():
+        ratio = f"{r['ratio']:.3f}" if r["ratio"] is not None else "-"
+        print(f"{k:60s} {r['old']:>14.6g} {r['new']:>14.6g} {ratio:>8s}")
+    return rows
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Text2Voice offline benchmarks (stub model)")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    sp = sub.add_parser("pipeline", help="временные WAV + pydub против сборки в памяти")
+    sp.add_argument("--blocks", type=int, default=100)
+
+    sp = sub.add_parser("workers", help="пропускная способность от числа процессов пула")
+    sp.add_argument("--max", type=int, default=os.cpu_count() or 1)
+    sp.add_argument("--blocks", type=int, default=32)
+    sp.add_argument("--speed", type=float, default=60.0, help="символов/с на процесс у заглушки")
+
+    sp = sub.add_parser("split", help="разбиение на блоки: скорость и свойства")
+    sp.add_argument("--mb", type=float, default=1.0)
+    sp.add_argument("--max-len", type=int, default=None, help="по умолчанию --block-len")
+    sp.add_argument("--lang", default="ru")
+    sp.add_argument("--cases", type=int, default=500)
+    sp.add_argument("--seed", type=int, default=0)
+
+    sp = sub.add_parser("longform", help="пиковая память длинной формы от длины текста")
+    sp.add_argument("--blocks", type=int, nargs="+", default=[10, 100, 1000])
+    sp.add_argument("--fmt", default="wav", choices=sorted(synth.OUT_FORMATS))
+
+    sp = sub.add_parser("_longform_child")
+    sp.add_argument("blocks", type=int)
+    sp.add_argument("fmt")
+
+    sp = sub.add_parser("micro", help="этапы по отдельности и накладные /progress")
+    sp.add_argument("--kb", type=float, default=200.0)
+    sp.add_argument("--blocks", type=int, default=40)
+    sp.add_argument("--requests", type=int, default=500)
+
+    sp = sub.add_parser("e2e", help="/synthesize под параллельными клиентами")
+    sp.add_argument("--clients", type=int, default=4)
+    sp.add_argument("--jobs", type=int, default=3, help="задач на клиента")
+    sp.add_argument("--chars", type=int, default=3000)
+    sp.add_argument("--speed", type=float, default=300.0, help="символов/с у заглушки")
+    sp.add_argument("--poll", type=float, default=0.05)
+
+    sp = sub.add_parser("rtf", help="real-time factor инференса")
+    sp.add_argument("--chars", type=int, default=2000)
+
+    sp = sub.add_parser("quant", help="T2V_CPU_MODE=fast против fp32: RTF, память, сходство")
+    sp.add_argument("--chars", type=int, default=2000)
+    sp.add_argument("--lang", default="ru")
+    sp.add_argument("--voice", help="эталонный голос (по умолчанию — синтетический)")
+    sp.add_argument("--reseed", action="store_true", help="ещё fp32 с другим seed — порог сходства")
+    sp = sub.add_parser("_quant_child")
+    sp.add_argument("seed", type=int)
+    sp.add_argument("out_dir", type=Path)
+    sp.add_argument("voice")
+    sp.add_argument("chars", type=int)
+    sp.add_argument("block_len", type=int)
+    sp.add_argument("lang")
+
+    sp = sub.add_parser("all", help="micro + split + e2e")
+    sp.add_argument("--kb", type=float, default=200.0)
+    sp.add_argument("--blocks", type=int, default=40)
+    sp.add_argument("--requests", type=int, default=500)
+    sp.add_argument("--mb", type=float, default=1.0)
+    sp.add_argument("--lang", default="ru")
+    sp.add_argument("--cases", type=int, default=200)
+    sp.add_argument("--seed", type=int, default=0)
+    sp.add_argument("--clients", type=int, default=4)
+    sp.add_argument("--jobs", type=int, default=3)
+    sp.add_argument("--chars", type=int, default=3000)
+    sp.add_argument("--speed", type=float, default=300.0)
+    sp.add_argument("--poll", type=float, default=0.05)
+
+    sp = sub.add_parser("compare", help="сравнить два JSON-прогона")
+    sp.add_argument("old", type=Path)
+    sp.add_argument("new", type=Path)
+
+    sp = sub.add_parser("_pipeline_child")
+    sp.add_argument("mode")
+    sp.add_argument("blocks", type=int)
+
+    sp = sub.add_parser("_workers_child")
+    sp.add_argument("blocks", type=int)
+
+    ap.add_argument("--json", type=Path, help="куда сохранить результаты")
+    ap.add_argument("--real", action="store_true", help="настоящая модель XTTS вместо заглушки")
+    ap.add_argument("--block-len", type=int, default=360)
+    args = ap.parse_args(argv)
+    if getattr(args, "speed", None) and args.cmd in ("e2e", "all") and not args.real:
+        # заглушка читает скорость при загрузке модели — до первого wait_model()
+        os.environ["T2V_STUB_SPEED"] = str(args.speed)
+
+    if args.cmd == "_pipeline_child":
+        print(json.dumps(_pipeline_child(args.mode, args.blocks)))
+        return
+    if args.cmd == "_longform_child":
+        print(json.dumps(_longform_child(args.blocks, args.fmt)))
+        return
+    if args.cmd == "_workers_child":
+        print(json.dumps(_workers_child(args.blocks)))
+        return
+    if args.cmd == "_quant_child":
+        print(json.dumps(_quant_child(args.seed, args.out_dir, args.voice, args.chars, args.block_len, args.lang)))
+        return
+    if args.cmd == "compare":
+        compare(args.old, args.new)
+        return
+    if args.cmd == "split":
+        args.max_len = args.block_len if args.max_len is None else args.max_len
+    elif args.cmd == "all":
+        args.max_len = args.block_len
+    res = {
+        "pipeline": bench_pipeline, "workers": bench_workers, "split": bench_split,
+        "longform": bench_longform, "micro": bench_micro, "e2e": bench_e2e, "rtf": bench_rtf, "quant": bench_quant,
+        "all": bench_all,
+    }[args.cmd](args)
+    out = {"meta": meta(args), "results": res}
+    print(json.dumps(out, indent=2, ensure_ascii=False))
+    if args.json:
+        args.json.write_text(json.dumps(out, indent=2, ensure_ascii=False), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
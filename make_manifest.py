@@ -0,0 +1,37 @@
+# make_manifest.py
+"""
+Манифест снапшота модели для rt_bootstrap.py: размер и sha256 каждого файла.
+Запускать на машине сборки перед PyInstaller:
+
+    py -3.11 make_manifest.py assets\\hf\\models--coqui-ai--XTTS-v2
+"""
+import sys
+import json
+import hashlib
+from pathlib import Path
+
+MANIFEST = ".t2v-manifest.json"     # то же имя ждёт rt_bootstrap.py
+
+
+def sha256(p: Path) -> str:
+    h = hashlib.sha256()
+    with open(p, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def build(root: Path) -> dict:
+    files = {}
+    for p in sorted(root.rglob("*")):
+        if p.is_file() and p.name != MANIFEST:
+            files[p.relative_to(root).as_posix()] = {"size": p.stat().st_size, "sha256": sha256(p)}
+    return {"version": 1, "files": files}
+
+
+if __name__ == "__main__":
+    root = Path(sys.argv[1] if len(sys.argv) > 1 else "assets/hf/models--coqui-ai--XTTS-v2")
+    man = build(root)
+    (root / MANIFEST).write_text(json.dumps(man, indent=1), encoding="utf-8")
+    total = sum(f["size"] for f in man["files"].values())
+    print(f"{root / MANIFEST}: {len(man['files'])} files, {total / 2**30:.2f} GiB")
@@ -1,5 +1,5 @@
 # rt_bootstrap.py
-import os, sys, shutil
+import os, sys, json, time, shutil, hashlib
 from pathlib import Path
 
 MEI = Path(getattr(sys, "_MEIPASS", Path.cwd()))
@@ -18,13 +18,78 @@ if ffmpeg.exists():
     except Exception:
         pass
 
-# 3) готовим оффлайн HuggingFace (копируем модель из бандла в пользовательский кэш)
+# 3) готовим оффлайн HuggingFace (модель из бандла -> пользовательский кэш)
+# Сверяемся с манифестом (make_manifest.py при сборке): на тёплом старте только stat файлов
+# из списка, битые/недостающие чиним поштучно — hardlink из бандла, иначе копия.
+MANIFEST = ".t2v-manifest.json"     # в корне снапшота в бандле
+STAMP = ".t2v-verified.json"        # в кэше: {rel: [size, mtime_ns]} проверенных файлов
+
+def _sha256(p: Path) -> str:
+    h = hashlib.sha256()
+    with open(p, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _place(src: Path, dst: Path) -> str:
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(dst.name + ".t2v-tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)           # тот же диск: мгновенно и без лишнего места
+        how = "linked"
+    except OSError:
+        shutil.copy2(src, tmp)
+        how = "copied"
+    os.replace(tmp, dst)
+    return how
+
+def provision(src: Path, dst: Path) -> dict:
+    man = json.loads((src / MANIFEST).read_text(encoding="utf-8"))
+    try:
+        stamp = json.loads((dst / STAMP).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        stamp = {}
+    stats = dict(ok=0, verified=0, linked=0, copied=0)
+    for rel, meta in man["files"].items():
+        d = dst / rel
+        try:
+            st = d.stat()
+        except OSError:
+            st = None
+        if st is not None and st.st_size == meta["size"]:
+            if stamp.get(rel) == [st.st_size, st.st_mtime_ns]:
+                stats["ok"] += 1
+                continue
+            if _sha256(d) == meta["sha256"]:     # файл есть, но не проверялся нами
+                stamp[rel] = [st.st_size, st.st_mtime_ns]
+                stats["verified"] += 1
+                continue
+        stats[_place(src / rel, d)] += 1
+        st = d.stat()
+        stamp[rel] = [st.st_size, st.st_mtime_ns]
+    dst.mkdir(parents=True, exist_ok=True)
+    tmp = dst / (STAMP + ".tmp")
+    tmp.write_text(json.dumps(stamp), encoding="utf-8")
+    os.replace(tmp, dst / STAMP)
+    return stats
+
 os.environ.setdefault("HF_HUB_OFFLINE", "1")
 src_hf = MEI / "assets" / "hf" / "models--coqui-ai--XTTS-v2"
 dst_root = Path.home() / ".cache" / "huggingface" / "hub"
 dst = dst_root / "models--coqui-ai--XTTS-v2"
 try:
-    if src_hf.exists():
+    t0 = time.perf_counter()
+    if src_hf.exists() and not MEI.name.startswith("_MEI"):
+        # onedir-сборка: бандл лежит постоянно — используем модель на месте, без копии
+        dst_root = src_hf.parent
+        print(f"[bootstrap] HF model used in place: {src_hf}")
+    elif src_hf.exists() and (src_hf / MANIFEST).exists():
+        st = provision(src_hf, dst)
+        print(f"[bootstrap] HF model cache: {st['ok']} ok, {st['verified']} verified, "
+              f"{st['linked']} linked, {st['copied']} copied in {(time.perf_counter() - t0) * 1000:.0f} ms")
+    elif src_hf.exists():
+        # сборка без манифеста — прежнее поведение
         dst_root.mkdir(parents=True, exist_ok=True)
         if not dst.exists() or not any(dst.rglob("*")):
             shutil.copytree(src_hf, dst, dirs_exist_ok=True)
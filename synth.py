@@ -3,23 +3,45 @@ from __future__ import annotations
 import os
 import re
 import uuid
+import hashlib
+import json
+import shutil
 import time
 import wave
+import struct
 import threading
+import multiprocessing
+import subprocess
+import zipfile
+import zlib
+import io
+import queue
+import difflib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
+import numpy as np
+import soundfile as sf
 from flask import (
-    Flask, request, send_from_directory, render_template_string, jsonify, url_for
+    Flask, request, send_from_directory, render_template_string, jsonify, url_for,
+    Response, stream_with_context, redirect
 )
 from pydub import AudioSegment
-from TTS.api import TTS
+
+from xtts_pool import XttsPool, xtts_latents, xtts_infer, take_shared, model_bytes, prepare_model, CPU_MODES
 
 DOCS_DIR   = Path.home() / "Documents" / "Text2Voice"
 VOICE_DIR  = DOCS_DIR / "voices"
 OUT_DIR    = DOCS_DIR / "outputs"
 TMP_DIR    = DOCS_DIR / "tmp"
-for p in (VOICE_DIR, OUT_DIR, TMP_DIR):
+LATENT_DIR = DOCS_DIR / "latents"
+BLOCK_DIR  = DOCS_DIR / "blocks"
+JOBS_DIR   = DOCS_DIR / "jobs"
+PROFILE_DIR = DOCS_DIR / "profiles"
+for p in (VOICE_DIR, OUT_DIR, TMP_DIR, LATENT_DIR, BLOCK_DIR, JOBS_DIR, PROFILE_DIR):
     p.mkdir(parents=True, exist_ok=True)
 
 MODEL_DIR  = DOCS_DIR / "model" 
@@ -37,31 +59,237 @@ LANGS = {
 }
 DEFAULT_LANG = "ru"
 RECENT_VOICES = 12
+# пакетный синтез (/batch): лимит элементов и длина блока для коротких фраз
+BATCH_MAX_ITEMS = 5000
+BATCH_BLOCK_LEN = 360
+# короткий прогревочный синтез после загрузки модели ("" — без прогрева)
+WARMUP_TEXT = os.environ.get("T2V_WARMUP", "Прогрев модели.")
+LATENT_MEM_ITEMS = 8     # сколько эталонов держим латентами в памяти
+OUT_SR = 24000
+# блоки держим в памяти; T2V_SPILL=1 — сбрасывать их в TMP_DIR (.npy) для очень длинных текстов
+SPILL_TO_DISK = os.environ.get("T2V_SPILL", "0") == "1"
+# блоки в памяти для /stream: сколько последних держать, пока ни один слушатель не подключён
+STREAM_BACKLOG = int(os.environ.get("T2V_STREAM_BACKLOG", "8"))
+# чекпоинты задач (JOBS_DIR/<job_id>): после рестарта задачу можно продолжить с последнего блока
+CHECKPOINT_JOBS = os.environ.get("T2V_CHECKPOINT", "1") == "1"
+AUTORESUME      = os.environ.get("T2V_AUTORESUME", "0") == "1"
+# реестр задач в памяти: завершённые живут JOB_TTL_SEC, всего записей не больше JOB_MAX
+JOB_TTL_SEC = int(os.environ.get("T2V_JOB_TTL", "3600"))
+JOB_MAX     = int(os.environ.get("T2V_JOB_MAX", "500"))
+# каталоги задач в JOBS_DIR удаляются целиком: завершённые и упавшие — через T2V_JOB_KEEP секунд,
+# прерванные и так и не продолженные — через T2V_JOB_STALE
+JOB_KEEP_SEC  = int(os.environ.get("T2V_JOB_KEEP", "86400"))
+JOB_STALE_SEC = int(os.environ.get("T2V_JOB_STALE", str(7 * 86400)))
+# задачи из UI, которые никто не опрашивает и не слушает столько секунд, отменяются (0 — никогда)
+ABANDON_SEC = int(os.environ.get("T2V_ABANDON_SEC", "120"))
+# кэш готовых блоков на диске (МБ; 0 — выключен)
+BLOCK_CACHE_MB = int(os.environ.get("T2V_BLOCK_CACHE_MB", "2048"))
+# движок: thread — модель в этом процессе; procs — T2V_PROCS процессов-реплик (xtts_pool)
+ENGINE        = os.environ.get("T2V_ENGINE", "thread")
+PROCS         = int(os.environ.get("T2V_PROCS", "2"))
+PROC_THREADS  = int(os.environ.get("T2V_PROC_THREADS", "0"))   # 0 — поровну ядер на процесс
+# режим CPU: fp32 — как есть; fast — int8-квантование GPT/декодера, inference_mode, явные потоки
+# (T2V_THREADS intra-op, 0 — все ядра; T2V_INTEROP inter-op, 0 — 1). Звучит чуть иначе — см. bench.py quant
+CPU_MODE        = os.environ.get("T2V_CPU_MODE", "fp32")
+if CPU_MODE not in CPU_MODES or WANT_GPU:
+    CPU_MODE = "fp32"
+TORCH_THREADS   = int(os.environ.get("T2V_THREADS", "0"))
+INTEROP_THREADS = int(os.environ.get("T2V_INTEROP", "0"))
+# планировщик: сколько блоков одновременно идёт в модель, сколько задач активно, длина очереди
+INFER_WORKERS = int(os.environ.get("T2V_WORKERS", str(PROCS if ENGINE == "procs" else 1)))
+JOB_RUNNERS   = int(os.environ.get("T2V_RUNNERS", "4"))
+MAX_QUEUE     = int(os.environ.get("T2V_MAX_QUEUE", "32"))
+# конвейер блока: инференс -> постобработка (потоки T2V_POST_WORKERS) -> запись;
+# между стадиями не больше T2V_PIPE_DEPTH блоков
+POST_WORKERS  = int(os.environ.get("T2V_POST_WORKERS", "2"))
+PIPE_DEPTH    = int(os.environ.get("T2V_PIPE_DEPTH", "4"))
+# постобработка (по умолчанию выключена, звук как раньше — пиковая нормализация):
+# T2V_TRIM=1 — срез тишины по краям блока, T2V_LOUDNESS=-20 — громкость по RMS, dBFS
+TRIM_SILENCE  = os.environ.get("T2V_TRIM", "0") == "1"
+_LOUD = os.environ.get("T2V_LOUDNESS", "").strip()
+try:
+    LOUDNESS_DB = float(_LOUD) if _LOUD else None
+except ValueError:
+    print(f"[post] T2V_LOUDNESS={_LOUD!r} is not a number — loudness levelling off")
+    LOUDNESS_DB = None
 
 def safe_name(name: str) -> str:
     return Path(name).name.replace(" ", "_").replace("\\", "_").replace("/", "_")
 
 def ensure_wav_24k_mono(src: Path) -> Path:
     """
-    Гарантируем mono/24k WAV (быстро, если уже ок).
+    Гарантируем mono/24k WAV (быстро, если уже ок; конвертация кэшируется в библиотеке голосов).
     """
-    if src.suffix.lower() == ".wav":
-        try:
-            with wave.open(str(src), "rb") as w:
-                if w.getnchannels() == 1 and w.getframerate() == 24000:
-                    return src
-        except wave.Error:
-            pass
-    dst = VOICE_DIR / f"{src.stem}_24k.wav"
-    seg = AudioSegment.from_file(str(src))
-    seg = seg.set_frame_rate(24000).set_channels(1)
-    seg.export(str(dst), format="wav")
-    return dst
+    return VOICES.wav_for(src)
 
-def list_recent_voices(n: int = RECENT_VOICES) -> List[Path]:
-    files = [p for p in VOICE_DIR.glob("*.*") if p.is_file()]
-    files.sort(key=lambda p: p.stat().st_mtime, reverse=True)
-    return files[:n]
+def list_recent_voices(n: int = RECENT_VOICES) -> List[Dict]:
+    return VOICES.recent(n)
+
+# ---- библиотека голосов ----
+class VoiceRegistry:
+    """
+    Индекс эталонов VOICE_DIR/index.json, ключ — sha1 содержимого:
+    {name, wav (24k/mono для модели), duration, size, mtime, added, used}.
+    Эталоны вне библиотеки хранятся по абсолютному пути и в «недавние» не попадают.
+    Одинаковые загрузки не плодят копий, одноимённые разные — не затирают друг друга,
+    конвертация в 24k делается один раз, «недавние» берутся из индекса без обхода папки.
+    """
+    def __init__(self, root: Path):
+        self.root = root
+        self.conv_dir = root / "24k"
+        self.path = root / "index.json"
+        self._lock = threading.RLock()
+        self._items: Optional[Dict[str, Dict]] = None
+
+    def _load(self) -> Dict[str, Dict]:
+        if self._items is None:
+            data = _read_json(self.path)
+            self._items = {}
+            if data is None:
+                self._migrate()
+            else:
+                self._items = data.get("voices", {})
+        return self._items
+
+    def _save(self):
+        _write_json(self.path, {"version": 1, "voices": self._items})
+
+    def _migrate(self):
+        # первый запуск с индексом: один раз подхватываем то, что уже лежит в папке
+        for p in sorted(self.root.glob("*.*"), key=lambda p: p.stat().st_mtime):
+            if p.is_file() and p.suffix.lower() not in (".json", ".tmp"):
+                try:
+                    self._register(p, used=p.stat().st_mtime)
+                except OSError:
+                    pass
+        self._save()
+
+    def _rel(self, p: Path) -> str:
+        # файлы библиотеки — относительно root, остальные — абсолютным путём
+        p = p.resolve()
+        try:
+            return p.relative_to(self.root.resolve()).as_posix()
+        except ValueError:
+            return str(p)
+
+    def _register(self, p: Path, used: Optional[float] = None) -> str:
+        key = file_digest(p)
+        name = self._rel(p)
+        in_lib = not Path(name).is_absolute()
+        e = self._items.get(key)
+        if (e is None or not (self.root / e["name"]).is_file()
+                or (in_lib and Path(e["name"]).is_absolute())):
+            if in_lib:
+                # файл с этим именем перезаписан другим содержимым — старая запись больше не его
+                for k in [k for k, x in self._items.items() if x["name"] == name and k != key]:
+                    del self._items[k]
+            st = p.stat()
+            self._items[key] = dict(name=name, wav=None, duration=None, size=st.st_size,
+                                    mtime=st.st_mtime, added=time.time(), used=used or time.time())
+        return key
+
+    def _by_name(self, name: str) -> Optional[str]:
+        for key, e in self._load().items():
+            if e["name"] == name:
+                return key
+        return None
+
+    def add_upload(self, up) -> Path:
+        """
+        Загрузка из формы: тот же контент — уже лежащий файл, иначе новый файл
+        (при совпадении имени с другим содержимым к имени добавляется хэш).
+        """
+        tmp = self.root / f".upload_{uuid.uuid4().hex}.tmp"
+        up.save(str(tmp))
+        with self._lock:
+            items = self._load()
+            key = file_digest(tmp)
+            e = items.get(key)
+            if e is not None and not Path(e["name"]).is_absolute() and (self.root / e["name"]).is_file():
+                tmp.unlink(missing_ok=True)
+                e["used"] = time.time()
+                self._save()
+                return self.root / e["name"]
+            name = safe_name(up.filename)
+            dest = self.root / name
+            if dest.exists():
+                dest = dest.with_name(f"{dest.stem}_{key[:8]}{dest.suffix}")
+            os.replace(tmp, dest)
+            self._register(dest)
+            self._save()
+            return dest
+
+    def find(self, name: str) -> Optional[Path]:
+        """
+        Эталон по имени файла из библиотеки (файлы, подложенные вручную, попадают в индекс).
+        """
+        p = self.root / safe_name(name)
+        with self._lock:
+            if self._by_name(p.name) is None:
+                if not p.is_file():
+                    return None
+                self._register(p)
+                self._save()
+        return p if p.is_file() else None
+
+    def wav_for(self, src: Path) -> Path:
+        """
+        24k/mono WAV для эталона: из индекса, если уже конвертирован, иначе конвертируем один раз.
+        """
+        src = src.resolve()
+        with self._lock:
+            self._load()
+            key = self._register(src)
+            e = self._items[key]
+            e["used"] = time.time()
+            wav = self.root / e["wav"] if e.get("wav") else None
+            if wav is not None and wav.is_file():
+                self._save()
+                return wav
+        # ffmpeg — вне замка: «недавние» и другие /synthesize не ждут чужую конвертацию
+        wav = self._convert(src, key)
+        try:
+            duration = float(sf.info(str(wav)).duration)
+        except Exception:
+            duration = None
+        with self._lock:
+            e = self._items.get(key)
+            if e is not None:
+                e["wav"] = self._rel(wav)
+                if duration is not None:
+                    e["duration"] = duration
+                self._save()
+        return wav
+
+    def _convert(self, src: Path, key: str) -> Path:
+        if src.suffix.lower() == ".wav":
+            try:
+                with wave.open(str(src), "rb") as w:
+                    if w.getnchannels() == 1 and w.getframerate() == 24000:
+                        return src
+            except wave.Error:
+                pass
+        self.conv_dir.mkdir(exist_ok=True)
+        dst = self.conv_dir / f"{key}.wav"
+        tmp = dst.with_name(f"{key}.{threading.get_ident()}.tmp")
+        seg = AudioSegment.from_file(str(src))
+        seg = seg.set_frame_rate(24000).set_channels(1)
+        seg.export(str(tmp), format="wav")
+        os.replace(tmp, dst)
+        return dst
+
+    def recent(self, n: int = RECENT_VOICES) -> List[Dict]:
+        with self._lock:
+            items = sorted(self._load().items(), key=lambda kv: kv[1].get("used") or 0, reverse=True)
+        out = []
+        for key, e in items:
+            if not Path(e["name"]).is_absolute() and (self.root / e["name"]).is_file():
+                out.append(dict(e, hash=key))
+                if len(out) >= n:
+                    break
+        return out
+
+VOICES = VoiceRegistry(VOICE_DIR)
 
 _SENT_SPLIT = re.compile(r"(?<=[\.\!\?\…])\s+")
 _WS = re.compile(r"\s+")
@@ -82,29 +310,789 @@ def normalize_text(txt: str, hard: bool = True) -> str:
         t += "."
     return t
 
-def split_into_blocks(txt: str, max_len: int) -> List[str]:
+# ---- разбиение на блоки ----
+# Блок меряется и в символах (max_len из формы), и в токенах XTTS: у GPT-части потолок
+# gpt_max_text_tokens=402 (плюс токены языка/старта), длиннее — inference падает.
+TOKEN_LIMIT = int(os.environ.get("T2V_TOKEN_LIMIT", "360"))
+_CLAUSE_SPLIT = re.compile(r"(?<=[;:])\s+|\s+(?=[—–]\s)")
+_COMMA_SPLIT = re.compile(r"(?<=,)\s+")
+_DIGITS = re.compile(r"\d")
+_CHARS_PER_TOKEN = {"zh-cn": 1, "ja": 1, "ko": 1}      # оценка без токенизатора; остальные — 2
+_BPE = None
+_BPE_TRIED: Optional[bool] = None     # готовность модели на момент последнего поиска
+
+def xtts_tokenizer():
     """
-    Рубим по предложениям на блоки ≤ max_len, соблюдая границы.
+    BPE-токенизатор XTTS (Rust, tokenizers) прямо из vocab.json рядом с весами —
+    модель для этого не нужна, работает и в режиме procs. None, пока весов нет
+    (ищем до загрузки модели и ещё раз после).
     """
-    sents = [s.strip() for s in _SENT_SPLIT.split(txt) if s.strip()]
-    blocks: List[str] = []
-    cur = ""
-    for s in sents:
-        if not cur:
-            cur = s
-        elif len(cur) + 1 + len(s) <= max_len:
-            cur = f"{cur} {s}"
+    global _BPE, _BPE_TRIED
+    if _BPE is None and _BPE_TRIED != _MODEL_READY.is_set():
+        _BPE_TRIED = _MODEL_READY.is_set()
+        try:
+            from tokenizers import Tokenizer
+            vocab = next(MODEL_DIR.rglob("vocab.json"), None)
+            if vocab is not None:
+                _BPE = Tokenizer.from_file(str(vocab))
+        except Exception:
+            pass
+    return _BPE
+
+def count_tokens(pieces: List[str], lang: str) -> List[int]:
+    """
+    Токены XTTS на каждый кусок. Как VoiceBpeTokenizer: нижний регистр, пробел -> [SPACE].
+    Числа модель разворачивает в слова, поэтому за каждую цифру накидываем ещё 2 токена.
+    Без токенизатора — оценка сверху по символам.
+    """
+    extra = [2 * len(_DIGITS.findall(x)) for x in pieces]
+    tok = xtts_tokenizer()
+    if tok is None:
+        cpt = _CHARS_PER_TOKEN.get(lang, 2)
+        return [-(-len(x) // cpt) + e for x, e in zip(pieces, extra)]
+    enc = tok.encode_batch([x.lower().replace(" ", "[SPACE]") for x in pieces], add_special_tokens=False)
+    return [len(x.ids) + e for x, e in zip(enc, extra)]
+
+def _cuts(lens: List[int], toks: List[int], cap_len: float, cap_tok: float) -> List[int]:
+    """
+    Жадная упаковка подряд идущих кусков (склейка — пробел: +1 символ, +1 токен [SPACE]).
+    Возвращает индексы, с которых начинаются блоки 2..N. Для «не больше N блоков при
+    потолке» жадность оптимальна.
+    """
+    cuts: List[int] = []
+    c = t = -1
+    for i, (n, k) in enumerate(zip(lens, toks)):
+        if c < 0:
+            c, t = n, k
+        elif c + 1 + n > cap_len or t + 1 + k > cap_tok:
+            cuts.append(i)
+            c, t = n, k
+        else:
+            c += 1 + n
+            t += 1 + k
+    return cuts
+
+def _balanced(pieces: List[str], toks: List[int], max_len: int, max_tok: int) -> List[str]:
+    """
+    Блоков — минимум (жадная упаковка), а размеры выравниваем: двоичным поиском ищем
+    наименьший потолок, при котором блоков столько же, — без огрызка в конце.
+    """
+    lens = [len(x) for x in pieces]
+    best = _cuts(lens, toks, max_len, max_tok)
+    lo, hi = 0.0, 1.0
+    for _ in range(14):
+        mid = (lo + hi) / 2
+        c = _cuts(lens, toks, max_len * mid, max_tok * mid)
+        if len(c) <= len(best):
+            best, hi = c, mid
+        else:
+            lo = mid
+    bounds = [0] + best + [len(pieces)]
+    return [" ".join(pieces[a:b]) for a, b in zip(bounds, bounds[1:])]
+
+def _has_word(s: str) -> bool:
+    return any(ch.isalnum() for ch in s)
+
+def _fit(s: str, max_len: int, max_tok: int, lang: str) -> List[str]:
+    """
+    Одно слишком длинное предложение -> куски в пределах лимитов:
+    сначала по ; : и тире, затем по запятым, затем по словам; слово длиннее лимита режем по символам.
+    Куски не склеиваем — их упаковывает _balanced вместе с соседними предложениями.
+    """
+    if len(s) <= max_len and count_tokens([s], lang)[0] <= max_tok:
+        return [s]
+    for rx in (_CLAUSE_SPLIT, _COMMA_SPLIT, _WS):
+        parts = [x for x in rx.split(s) if x]
+        if len(parts) > 1:
+            return [y for x in parts for y in _fit(x, max_len, max_tok, lang)]
+    # ≤ 1 токена на символ у BPE, +2 за цифру
+    n = max(1, min(max_len, max_tok // 3))
+    out: List[str] = []
+    for i in range(0, len(s), n):
+        c = s[i:i + n]
+        # кусок без букв и цифр XTTS не озвучит — склеиваем с соседним
+        if out and not (_has_word(c) and _has_word(out[-1])):
+            out[-1] += c
+        else:
+            out.append(c)
+    return out
+
+def split_into_blocks(txt: str, max_len: int, lang: str = "en", max_tokens: int = TOKEN_LIMIT) -> List[str]:
+    """
+    Рубим по предложениям на блоки ≤ max_len символов и ≤ max_tokens токенов XTTS.
+    Длинные предложения дробим по придаточным/запятым (_fit), затем упаковываем (_balanced).
+    """
+    sents = [x.strip() for x in _SENT_SPLIT.split(txt) if x.strip()]
+    if not sents:
+        return []
+    max_tokens = min(max_tokens, TOKEN_LIMIT)
+    pieces: List[str] = []
+    toks: List[int] = []
+    for x, k in zip(sents, count_tokens(sents, lang)):
+        if len(x) <= max_len and k <= max_tokens:
+            pieces.append(x)
+            toks.append(k)
+        else:
+            sub = _fit(x, max_len, max_tokens, lang)
+            pieces.extend(sub)
+            toks.extend(count_tokens(sub, lang))
+    return _balanced(pieces, toks, max_len, max_tokens)
+
+# ---- метрики ----
+# Свой минимальный экспорт в текстовом формате Prometheus (без prometheus_client):
+# гистограммы, счётчики и гейджи с метками, /metrics отдаёт всё разом.
+_METRICS: List["_Metric"] = []
+_METRICS_LOCK = threading.Lock()
+_SEC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def _labels(d: Dict) -> str:
+    if not d:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(d.items())) + "}"
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name, self.help = name, help
+        self._vals: Dict[Tuple, object] = {}
+        _METRICS.append(self)
+
+    def _lines(self, labels: Dict, v) -> List[str]:
+        return [f"{self.name}{_labels(labels)} {v}"]
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with _METRICS_LOCK:
+            for key, v in sorted(self._vals.items()):
+                out += self._lines(dict(key), v)
+        return out
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, n: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _METRICS_LOCK:
+            self._vals[key] = self._vals.get(key, 0) + n
+
+class Gauge(_Metric):
+    """
+    Значение снимается в момент запроса /metrics: fn() -> число (None — не отдавать).
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            v = self.fn()
+        except Exception:
+            v = None
+        if v is None:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", f"{self.name} {v}"]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=_SEC_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, v: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with _METRICS_LOCK:
+            h = self._vals.get(key)
+            if h is None:
+                h = self._vals[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if v <= b:
+                    h[0][i] += 1
+            h[1] += v
+            h[2] += 1
+
+    def _lines(self, labels: Dict, h) -> List[str]:
+        out = [f"{self.name}_bucket{_labels({**labels, 'le': b})} {c}" for b, c in zip(self.buckets, h[0])]
+        out.append(f"{self.name}_bucket{_labels({**labels, 'le': '+Inf'})} {h[2]}")
+        out.append(f"{self.name}_sum{_labels(labels)} {h[1]}")
+        out.append(f"{self.name}_count{_labels(labels)} {h[2]}")
+        return out
+
+STAGE_SEC = Histogram("t2v_stage_seconds", "Time spent per pipeline stage")
+BLOCK_RTF = Histogram("t2v_block_rtf", "Real-time factor per synthesized block (inference sec / audio sec)",
+                      (0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10))
+QUEUE_WAIT = Histogram("t2v_queue_wait_seconds", "Time a job waited in the scheduler queue")
+JOBS_TOTAL = Counter("t2v_jobs_total", "Finished jobs by kind and status")
+BLOCKS_TOTAL = Counter("t2v_blocks_total", "Synthesized blocks by source (model or cache)")
+ERRORS_TOTAL = Counter("t2v_errors_total", "Errors by place")
+CACHE_SAVED = Counter("t2v_block_cache_saved_bytes_total", "Audio bytes served from the block cache instead of the model")
+
+def add_stage(p: Optional[Dict], stage: str, sec: float):
+    STAGE_SEC.observe(sec, stage=stage)
+    if p is not None:
+        st = p.setdefault("stages", {})
+        st[stage] = st.get(stage, 0.0) + sec
+
+@contextmanager
+def timed(p: Optional[Dict], stage: str):
+    """
+    Время этапа — в гистограмму t2v_stage_seconds и в p["stages"] задачи.
+    """
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage(p, stage, time.perf_counter() - t)
+
+def render_metrics() -> str:
+    return "\n".join(line for m in _METRICS for line in m.render()) + "\n"
+
+# ---- профилирование задачи (?profile=1 | torch) ----
+PROFILERS = {"0": "", "1": "cprofile", "cprofile": "cprofile", "torch": "torch"}
+
+def run_profiled(job_id: str, kind: str, fn, *args):
+    """
+    Прогон задачи под профилировщиком, результат — PROFILE_DIR/<job_id>.*:
+    cprofile -> .prof (pstats/snakeviz), torch -> .json (chrome://tracing, perfetto).
+    Профилируется поток задачи (инференс в режиме thread); постобработка и запись идут в своих
+    потоках конвейера, в режиме procs инференс — в процессах пула, в cProfile они не попадают.
+    """
+    p = PROGRESS[job_id]
+    if kind == "torch":
+        from torch.profiler import profile, ProfilerActivity
+        acts = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if WANT_GPU else [])
+        out = PROFILE_DIR / f"{job_id}.json"
+        with profile(activities=acts, record_shapes=True) as prof:
+            fn(*args)
+        prof.export_chrome_trace(str(out))
+    else:
+        import cProfile
+        out = PROFILE_DIR / f"{job_id}.prof"
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            fn(*args)
+        finally:
+            prof.disable()
+            prof.dump_stats(str(out))
+    p["profile"] = out.name
+
+# ---- загрузка модели в фоне ----
+# Сервер поднимается сразу, модель грузится отдельным потоком, затем короткий прогрев,
+# чтобы первый запрос не платил за холодные ядра torch. Задачи до готовности ждут в очереди.
+TTS_MODEL = None
+MODEL_STATE: Dict = dict(phase="idle", started=None, load_sec=None, warmup_sec=None, ready_at=None, error=None)
+_MODEL_READY = threading.Event()
+_LOADER: Optional[threading.Thread] = None
+_LOADER_LOCK = threading.Lock()
+
+def start_model_loader():
+    global _LOADER
+    with _LOADER_LOCK:
+        if _LOADER is None:
+            _LOADER = threading.Thread(target=_load_model, name="t2v-model-loader", daemon=True)
+            _LOADER.start()
+
+def wait_model():
+    """
+    Блокирует до готовности модели (запуская загрузку, если её ещё не было).
+    """
+    start_model_loader()
+    _MODEL_READY.wait()
+    if MODEL_STATE["phase"] != "ready":
+        raise RuntimeError(f"модель не загрузилась: {MODEL_STATE['error']}")
+
+def _warmup_ref() -> Path:
+    # синтетический эталон для прогрева, чтобы не трогать кэши реальных голосов
+    p = LATENT_DIR / "warmup_ref.wav"
+    if not p.exists():
+        rng = np.random.default_rng(0)
+        sf.write(str(p), (0.05 * rng.standard_normal(OUT_SR * 3)).astype(np.float32), OUT_SR)
+    return p
+
+def _load_model():
+    global TTS_MODEL
+    MODEL_STATE.update(phase="loading", started=time.time())
+    try:
+        t0 = time.time()
+        if ENGINE == "procs":
+            # модель живёт только в процессах пула, они грузят её при первом блоке (прогреве)
+            print(f"[XTTS] engine=procs: starting {PROCS} worker processes…")
+            pool = get_pool()
         else:
-            blocks.append(cur)
-            cur = s
-    if cur:
-        blocks.append(cur)
-    return blocks
+            print("[XTTS] loading model… (first run may take a minute)")
+            from TTS.api import TTS
+            TTS_MODEL = TTS(model_name=MODEL_NAME, gpu=WANT_GPU)
+            fast = CPU_MODE == "fast"
+            MODEL_STATE["cpu"] = prepare_model(
+                xtts_model(), CPU_MODE,
+                TORCH_THREADS or ((os.cpu_count() or 1) if fast else 0), INTEROP_THREADS or int(fast),
+            )
+            install_cancel_hook(xtts_model())
+        MODEL_STATE["load_sec"] = time.time() - t0
+
+        if WARMUP_TEXT:
+            MODEL_STATE["phase"] = "warmup"
+            t1 = time.time()
+            ref = _warmup_ref()
+            if ENGINE == "procs":
+                futs = [pool.submit(WARMUP_TEXT, DEFAULT_LANG, ref, "warmup", LATENT_DIR / f"warmup{LATENT_TAG}.pt")
+                        for _ in range(pool.size)]
+                for f in futs:
+                    take_shared(f.result())
+            else:
+                gpt, spk = xtts_latents(xtts_model(), ref)
+                infer_block(WARMUP_TEXT, DEFAULT_LANG, gpt, spk)
+            MODEL_STATE["warmup_sec"] = time.time() - t1
+        try:
+            MODEL_STATE["model_bytes"] = pool.model_bytes() if ENGINE == "procs" else model_bytes(xtts_model())
+            if ENGINE == "procs":
+                MODEL_STATE["cpu"] = dict(pool.prepared() or {}, threads=pool.threads)
+        except Exception:
+            pass
+
+        MODEL_STATE.update(phase="ready", ready_at=time.time())
+        print(f"[XTTS] ready ✓ (load {MODEL_STATE['load_sec']:.1f}s, warm-up {MODEL_STATE['warmup_sec'] or 0:.1f}s, cpu {CPU_MODE})")
+    except Exception as e:
+        MODEL_STATE.update(phase="error", error=f"{e}")
+        ERRORS_TOTAL.inc(where="model")
+        print(f"[XTTS] load failed: {e}")
+    finally:
+        _MODEL_READY.set()
+
+_POOL: Optional[XttsPool] = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool() -> XttsPool:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = XttsPool(PROCS, MODEL_NAME, gpu=WANT_GPU, threads=PROC_THREADS, mode=CPU_MODE)
+        return _POOL
+
+# ---- кэш латентов эталонного голоса ----
+# XTTS на каждый tts_to_file заново считает gpt_cond_latent + speaker_embedding
+# из того же WAV. Считаем один раз на эталон: память (LRU) -> диск (.pt) -> модель.
+_LATENTS: "OrderedDict[str, Tuple[object, object]]" = OrderedDict()
+_LATENT_LOCK = threading.Lock()
+_DIGESTS: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_DIGEST_LOCK = threading.Lock()
+DIGEST_ITEMS = 1024
+LATENT_STATS = dict(mem_hits=0, disk_hits=0, misses=0, compute_sec=0.0)
+LATENT_TAG = "" if CPU_MODE == "fp32" else f"-{CPU_MODE}"   # int8-кондиционер даёт свои латенты
+
+def file_digest(p: Path) -> str:
+    """
+    sha1 содержимого файла; повторно не читаем, пока не изменились mtime/размер
+    (последние DIGEST_ITEMS файлов, временные загрузки .tmp не запоминаем).
+    """
+    st = p.stat()
+    k = (str(p), st.st_mtime_ns, st.st_size)
+    with _DIGEST_LOCK:
+        d = _DIGESTS.get(k)
+        if d is not None:
+            _DIGESTS.move_to_end(k)
+            return d
+    h = hashlib.sha1()
+    with open(p, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    d = h.hexdigest()
+    if p.suffix != ".tmp":
+        with _DIGEST_LOCK:
+            _DIGESTS[k] = d
+            while len(_DIGESTS) > DIGEST_ITEMS:
+                _DIGESTS.popitem(last=False)
+    return d
+
+def xtts_model():
+    return TTS_MODEL.synthesizer.tts_model
+
+def voice_latents(voice_wav: Path) -> Tuple[object, object, str]:
+    """
+    Латенты XTTS для эталона (ключ — хэш 24k/mono WAV).
+    Возвращает (gpt_cond_latent, speaker_embedding, источник: mem|disk|miss).
+    """
+    import torch
+
+    key = file_digest(voice_wav)
+    with _LATENT_LOCK:
+        hit = _LATENTS.get(key)
+        if hit is not None:
+            _LATENTS.move_to_end(key)
+            LATENT_STATS["mem_hits"] += 1
+            return hit[0], hit[1], "mem"
+
+    path = LATENT_DIR / f"{key}{LATENT_TAG}.pt"
+    lat, src = None, "disk"
+    if path.exists():
+        try:
+            d = torch.load(str(path), map_location="cpu")
+            lat = (d["gpt"], d["spk"])
+        except Exception:
+            lat = None
+    if lat is None:
+        src = "miss"
+        t1 = time.time()
+        gpt, spk = xtts_latents(xtts_model(), voice_wav)
+        LATENT_STATS["compute_sec"] += time.time() - t1
+        lat = (gpt, spk)
+        try:
+            tmp = path.with_suffix(".tmp")
+            torch.save({"gpt": gpt, "spk": spk}, str(tmp))
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"[XTTS] latent cache write skipped: {e}")
+
+    with _LATENT_LOCK:
+        LATENT_STATS["disk_hits" if src == "disk" else "misses"] += 1
+        _LATENTS[key] = lat
+        _LATENTS.move_to_end(key)
+        while len(_LATENTS) > LATENT_MEM_ITEMS:
+            _LATENTS.popitem(last=False)
+    return lat[0], lat[1], src
+
+def latent_cost_sec() -> float:
+    """
+    Средняя цена расчёта латентов (для оценки сэкономленного времени).
+    """
+    n = LATENT_STATS["misses"]
+    return LATENT_STATS["compute_sec"] / n if n else 0.0
+
+def infer_block(text: str, lang: str, gpt, spk, p: Optional[Dict] = None):
+    """
+    Один блок через XTTS напрямую из готовых латентов; p — прогресс задачи для отмены внутри блока.
+    """
+    _INFER_JOB.p = p
+    try:
+        return xtts_infer(xtts_model(), text, lang, gpt, spk)
+    finally:
+        _INFER_JOB.p = None
+
+_INFER_JOB = threading.local()      # задача, чей блок сейчас в модели (в этом потоке)
+
+def _cancel_hook(module, args):
+    p = getattr(_INFER_JOB, "p", None)
+    if p is not None and p.get("cancel"):
+        raise JobCancelled(p["cancel"])
 
-print("[XTTS] loading model… (first run may take a minute)")
-TTS_MODEL = TTS(model_name=MODEL_NAME, gpu=WANT_GPU)
-print("[XTTS] ready ✓")
+def install_cancel_hook(m):
+    """
+    Отмена посреди длинного блока: GPT XTTS вызывается на каждый токен, pre-hook обрывает
+    генерацию исключением. Только T2V_ENGINE=thread — в procs блок в полёте досчитывается.
+    """
+    gpt = getattr(getattr(m, "gpt", None), "gpt_inference", None) or getattr(m, "gpt", None)
+    if gpt is not None and hasattr(gpt, "register_forward_pre_hook"):
+        gpt.register_forward_pre_hook(_cancel_hook)
 
+# ---- кэш готовых блоков ----
+def _model_version() -> str:
+    try:
+        from importlib.metadata import version
+        return f"{MODEL_NAME}@coqui-tts={version('coqui-tts')}"
+    except Exception:
+        return MODEL_NAME
+
+class BlockCache:
+    """
+    Аудио блоков на диске (float32 .npy, уже 24k/нормализованное).
+    Ключ — sha1(текст блока, хэш эталона, язык, версия модели, параметры синтеза).
+    Вытеснение LRU по размеру: порядок — по mtime, при чтении mtime обновляем.
+    """
+    def __init__(self, root: Path, cap_bytes: int):
+        self.root = root
+        self.cap = cap_bytes
+        self.version = _model_version()
+        self.params = f"sr={OUT_SR};split=1;trim={int(TRIM_SILENCE)};loud={LOUDNESS_DB}"
+        if CPU_MODE != "fp32":
+            self.params += f";cpu={CPU_MODE}"
+        self.stats = dict(hits=0, misses=0, bytes_saved=0, evictions=0, size_bytes=0)
+        self._lock = threading.Lock()
+        self._idx: "OrderedDict[str, int]" = OrderedDict()   # старые первыми
+        files = []
+        for f in root.glob("*.npy"):
+            try:
+                st = f.stat()
+                files.append((st.st_mtime, f.stem, st.st_size))
+            except OSError:
+                pass
+        for _, k, n in sorted(files):
+            self._idx[k] = n
+        self.stats["size_bytes"] = sum(self._idx.values())
+
+    def key(self, text: str, voice_key: str, lang: str) -> str:
+        t = _WS.sub(" ", text).strip()
+        raw = "\x1f".join((t, voice_key, lang, self.version, self.params))
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        if self.cap <= 0:
+            return None
+        with self._lock:
+            known = key in self._idx
+            if known:
+                self._idx.move_to_end(key)
+        path = self.root / f"{key}.npy"
+        a = None
+        if known:
+            try:
+                a = np.load(str(path))
+                os.utime(path)
+            except (OSError, ValueError):
+                a = None
+        with self._lock:
+            if a is None:
+                self.stats["misses"] += 1
+                if known and self._idx.pop(key, None) is not None:
+                    self.stats["size_bytes"] = sum(self._idx.values())
+            else:
+                self.stats["hits"] += 1
+                self.stats["bytes_saved"] += a.nbytes
+        return a
+
+    def put(self, key: str, a: np.ndarray):
+        if self.cap <= 0:
+            return
+        path = self.root / f"{key}.npy"
+        tmp = self.root / f"{key}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                np.save(f, np.asarray(a, dtype=np.float32))
+            os.replace(tmp, path)
+            n = path.stat().st_size
+        except OSError as e:
+            print(f"[cache] block write skipped: {e}")
+            return
+        drop: List[str] = []
+        with self._lock:
+            self._idx[key] = n
+            self._idx.move_to_end(key)
+            total = sum(self._idx.values())
+            while total > self.cap and len(self._idx) > 1:
+                k, sz = self._idx.popitem(last=False)
+                total -= sz
+                drop.append(k)
+            self.stats["size_bytes"] = total
+            self.stats["evictions"] += len(drop)
+        for k in drop:
+            try: (self.root / f"{k}.npy").unlink(missing_ok=True)
+            except OSError: pass
+
+BLOCK_CACHE = BlockCache(BLOCK_DIR, BLOCK_CACHE_MB * 1024 * 1024)
+
+# ---- сборка аудио в памяти ----
+def trim_silence(a: np.ndarray, floor_db: float = -40.0, keep_ms: int = 30) -> np.ndarray:
+    """
+    Срез тишины по краям блока (тише пика на floor_db), с запасом keep_ms —
+    иначе паузы между блоками «плывут» от хвостов модели.
+    """
+    if not a.size:
+        return a
+    loud = np.flatnonzero(np.abs(a) > float(np.max(np.abs(a))) * 10 ** (floor_db / 20))
+    if not loud.size:
+        return a
+    keep = OUT_SR * keep_ms // 1000
+    return a[max(0, loud[0] - keep):loud[-1] + 1 + keep]
+
+def block_audio(wav, sr: int) -> np.ndarray:
+    """
+    Сырой выход модели -> float32 mono/24k, срез тишины, громкость к LOUDNESS_DB по RMS
+    с ограничением пика (без LOUDNESS_DB — пиковая нормализация, как делал save_wav).
+    """
+    a = np.asarray(wav, dtype=np.float32)
+    if a.ndim > 1:
+        a = a.mean(axis=0 if a.shape[0] < a.shape[-1] else -1)
+    if sr != OUT_SR and a.size:
+        n = int(round(a.size * OUT_SR / sr))
+        a = np.interp(np.linspace(0, a.size - 1, n), np.arange(a.size), a).astype(np.float32)
+    if TRIM_SILENCE:
+        a = trim_silence(a)
+    peak = float(np.max(np.abs(a))) if a.size else 0.0
+    if LOUDNESS_DB is None or not a.size:
+        return a * (1.0 / max(0.01, peak))
+    rms = float(np.sqrt(np.mean(np.square(a, dtype=np.float64))))
+    gain = min(10 ** (LOUDNESS_DB / 20) / max(1e-4, rms), 0.99 / max(1e-4, peak))
+    return a * np.float32(gain)
+
+def assemble(chunks: List[np.ndarray], pause_ms: int) -> np.ndarray:
+    """
+    Склейка блоков с тихими паузами одним выделением памяти.
+    """
+    pad = int(OUT_SR * max(0, int(pause_ms)) / 1000)
+    out = np.zeros(sum(c.size for c in chunks) + pad * len(chunks), dtype=np.float32)
+    pos = 0
+    for c in chunks:
+        out[pos:pos + c.size] = c
+        pos += c.size + pad
+    return out
+
+# ---- форматы вывода ----
+# формат -> (расширение, mimetype, битрейт по умолчанию, кбит/с; 0 — без сжатия с потерями)
+OUT_FORMATS = {
+    "wav":  ("wav",  "audio/wav",  0),
+    "flac": ("flac", "audio/flac", 0),
+    "opus": ("ogg",  "audio/ogg",  48),
+    "mp3":  ("mp3",  "audio/mpeg", 128),
+}
+MIME_BY_EXT = {ext: mime for ext, mime, _ in OUT_FORMATS.values()}
+
+def ffmpeg_bin() -> str:
+    # rt_bootstrap кладёт путь к встроенному ffmpeg в FFMPEG_BINARY и AudioSegment.converter
+    return os.environ.get("FFMPEG_BINARY") or AudioSegment.converter or "ffmpeg"
+
+class AudioWriter:
+    """
+    Итоговый файл пишется по мере готовности блоков: WAV/FLAC — soundfile,
+    Opus(Ogg)/MP3 — ffmpeg, в stdin которому идёт PCM16. Пишем в *.part и переименовываем
+    в close(), так что /audio никогда не отдаёт недописанный файл.
+    """
+    def __init__(self, path: Path, fmt: str = "wav", bitrate: int = 0):
+        self.path = path
+        self.tmp = path.with_name(path.name + ".part")
+        self.frames = 0
+        self._sf = None
+        self._proc = None
+        if fmt in ("wav", "flac"):
+            self._sf = sf.SoundFile(str(self.tmp), "w", samplerate=OUT_SR, channels=1,
+                                    format=fmt.upper(), subtype="PCM_16")
+        else:
+            codec = {"opus": ["-c:a", "libopus", "-f", "ogg"], "mp3": ["-c:a", "libmp3lame", "-f", "mp3"]}[fmt]
+            kbps = bitrate or OUT_FORMATS[fmt][2]
+            self._proc = subprocess.Popen(
+                [ffmpeg_bin(), "-hide_banner", "-loglevel", "error", "-y",
+                 "-f", "s16le", "-ar", str(OUT_SR), "-ac", "1", "-i", "pipe:0",
+                 *codec, "-b:a", f"{kbps}k", str(self.tmp)],
+                stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+
+    def write(self, a: np.ndarray):
+        if not a.size:
+            return
+        if self._sf is not None:
+            self._sf.write(a)
+        else:
+            self._proc.stdin.write(pcm16(a))
+        self.frames += a.size
+
+    def close(self):
+        if self._sf is not None:
+            self._sf.close()
+        else:
+            self._proc.stdin.close()
+            err = self._proc.stderr.read().decode("utf-8", "replace").strip()
+            if self._proc.wait() != 0:
+                raise RuntimeError(f"ffmpeg: {err or self._proc.returncode}")
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        try:
+            if self._sf is not None:
+                self._sf.close()
+            elif self._proc.poll() is None:
+                self._proc.kill()
+                self._proc.wait()
+        except Exception:
+            pass
+        try: self.tmp.unlink(missing_ok=True)
+        except OSError: pass
+
+def silence(pause_ms: int) -> np.ndarray:
+    return np.zeros(int(OUT_SR * max(0, int(pause_ms)) / 1000), dtype=np.float32)
+
+# ---- длинная форма: главы ----
+_HEADING = re.compile(
+    r"^[ \t]*(?:#{1,6}[ \t]+\S.*|(?:глава|часть|пролог|эпилог|chapter|part|prologue|epilogue"
+    r"|kapitel|teil|capítulo|chapitre)\b.*)$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+def split_chapters(text: str) -> List[Tuple[str, str]]:
+    """
+    Текст -> [(заголовок, тело)] по строкам-заголовкам («Глава 3», «Chapter IV», «# Пролог»).
+    Текст до первого заголовка — глава с пустым заголовком; без заголовков — [].
+    """
+    def is_heading(line: str) -> bool:
+        # «Часть людей ушла в лес.» — это предложение, а не заголовок
+        return len(line) <= 80 and not (line[-1] in ".!?…" and len(line.split()) > 4)
+    heads = [m for m in _HEADING.finditer(text) if is_heading(m.group(0).strip())]
+    if not heads:
+        return []
+    out = []
+    pre = text[:heads[0].start()].strip()
+    if pre:
+        out.append(("", pre))
+    for m, nxt in zip(heads, heads[1:] + [None]):
+        title = m.group(0).strip().lstrip("#").strip()
+        out.append((title, text[m.end():nxt.start() if nxt else len(text)].strip()))
+    return out
+
+def _cue_time(sec: float) -> str:
+    f = int(round(sec * 75))        # кадры CD: 75 в секунду
+    return f"{f // 4500:02d}:{f // 75 % 60:02d}:{f % 75:02d}"
+
+class BookWriter:
+    """
+    Итоговый файл блок за блоком (+ пауза), память не растёт с длиной книги: в RAM только
+    текущий блок, WAV-заголовок soundfile дописывает при закрытии. Для глав запоминаем
+    начало (по числу записанных сэмплов), в конце пишем .cue рядом с файлом;
+    per_chapter — параллельно ещё по файлу на главу.
+    """
+    def __init__(self, out_path: Path, fmt: str, bitrate: int, pause_ms: int,
+                 chapters: Optional[List[Dict]] = None, per_chapter: bool = False):
+        self.fmt, self.bitrate = fmt, bitrate
+        self.main = AudioWriter(out_path, fmt, bitrate)
+        self.pad = silence(pause_ms)
+        self.chapters = [dict(c) for c in chapters or []]
+        self._at = {c["block"]: n for n, c in enumerate(self.chapters)}
+        self.per_chapter = per_chapter
+        self._cur: Optional[AudioWriter] = None
+
+    def write_block(self, i: int, a: np.ndarray):
+        """
+        i — номер блока с нуля (главы размечены по нему).
+        """
+        n = self._at.get(i)
+        if n is not None:
+            self.chapters[n]["start_sec"] = self.main.frames / OUT_SR
+            if self.per_chapter:
+                if self._cur is not None:
+                    self._cur.close()
+                path = self.main.path.with_name(f"{self.main.path.stem}_ch{n + 1:02d}{self.main.path.suffix}")
+                self._cur = AudioWriter(path, self.fmt, self.bitrate)
+                self.chapters[n]["file"] = path.name
+        for w in (self.main, self._cur):
+            if w is not None:
+                w.write(a)
+                w.write(self.pad)
+
+    def close(self):
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
+        self.main.close()
+        if self.chapters:
+            self.write_cue()
+
+    def write_cue(self):
+        kind = "MP3" if self.fmt == "mp3" else "WAVE"
+        lines = [f'FILE "{self.main.path.name}" {kind}']
+        for n, c in enumerate(self.chapters, 1):
+            title = (c.get("title") or "—").replace('"', "'")
+            lines += [f"  TRACK {n:02d} AUDIO", f'    TITLE "{title}"',
+                      f"    INDEX 01 {_cue_time(c.get('start_sec') or 0.0)}"]
+        self.main.path.with_suffix(".cue").write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    def abort(self):
+        for w in (self._cur, self.main):
+            if w is not None:
+                w.abort()
+        for c in self.chapters:
+            # уже закрытые файлы глав (текущий удалил abort)
+            if c.get("file"):
+                self.main.path.with_name(c["file"]).unlink(missing_ok=True)
 
 PROGRESS: Dict[str, Dict] = {}
 
@@ -227,12 +1215,36 @@ hr{border:none; border-top:1px solid var(--border); margin:14px 0}
                 </select>
               </div>
             </div>
+            <div class="grid" style="grid-template-columns: 1fr 1fr; margin-top:8px">
+              <div>
+                <label>Формат файла</label>
+                <select id="fmt">
+                  <option value="wav" selected>WAV (без сжатия)</option>
+                  <option value="flac">FLAC (без потерь)</option>
+                  <option value="opus">Opus / Ogg</option>
+                  <option value="mp3">MP3</option>
+                </select>
+              </div>
+              <div>
+                <label>Битрейт (кбит/с, Opus/MP3)</label>
+                <input id="bitrate" type="number" min="16" max="320" step="8" placeholder="авто"/>
+              </div>
+            </div>
+            <div style="margin-top:8px">
+              <label>Длинная форма (книга)</label>
+              <select id="longform">
+                <option value="" selected>Нет</option>
+                <option value="markers">Главы по заголовкам: метки (.cue)</option>
+                <option value="files">Главы по заголовкам: файл на главу</option>
+              </select>
+            </div>
             <div class="small muted">Совет: оставляй естественную пунктуацию. Перед точкой — пробелов не нужно.</div>
           </div>
         </div>
 
         <div>
           <button id="runBtn" class="btn" type="button">Синтезировать</button>
+          <button id="cancelBtn" class="btn secondary" type="button" style="display:none">Отменить</button>
         </div>
       </div>
 
@@ -247,7 +1259,7 @@ hr{border:none; border-top:1px solid var(--border); margin:14px 0}
             <select id="recent">
               <option value="">— выбор —</option>
               {% for v in recent %}
-                <option value="{{v.name}}">{{v.name}}</option>
+                <option value="{{v.name}}">{{v.name}}{% if v.duration %} · {{ '%.0f' % v.duration }} с{% endif %}</option>
               {% endfor %}
             </select>
           </div>
@@ -279,8 +1291,9 @@ hr{border:none; border-top:1px solid var(--border); margin:14px 0}
           <hr/>
           <div id="result" class="audio" style="display:none">
             <audio id="player" controls></audio>
-            <a id="download" class="btn secondary" download>Скачать WAV</a>
+            <a id="download" class="btn secondary" download style="display:none">Скачать WAV</a>
           </div>
+          <div id="chapters" class="small" style="display:none; margin-top:8px"></div>
         </div>
       </div>
     </div>
@@ -309,34 +1322,156 @@ function setProgress(p, done, total, eta, elapsed){
   $("#elapsed").textContent = fmtSec(elapsed);
   $("#eta").textContent = fmtSec(eta);
 }
+function setStream(url){
+  // играем по мере готовности блоков; полный файл подменим, когда поток доиграет
+  if (!url) return;
+  const pl = $("#player");
+  $("#result").style.display = "flex";
+  $("#download").style.display = "none";
+  pl.src = url;
+  pl.play().catch(()=>{});
+}
 function setReady(url){
   if (!url) return;
+  const pl = $("#player");
   $("#result").style.display = "flex";
-  $("#player").src = url;
-  $("#download").href = url;
+  $("#download").href = url + (url.includes("?") ? "&" : "?") + "download=1";
+  $("#download").style.display = "";
+  if (pl.src && !pl.paused && !pl.ended){
+    pl.addEventListener("ended", ()=>{ pl.src = url; }, {once:true});
+  }else{
+    pl.src = url;
+  }
 }
 
-let polling = null, jobId = null;
+let polling = null, jobId = null, es = null, tick = null, last = null;
+let lastDone = null;   // {id, text} прошлой готовой задачи: правка её текста уходит ревизией (сервер возьмёт неизменённые блоки)
+let runText = null;
+
+// новый текст — правка прошлого, если общие начало и конец покрывают хотя бы половину
+function isEditOf(prev, cur){
+  if (!prev) return false;
+  const n = Math.min(prev.length, cur.length);
+  let a = 0, b = 0;
+  while (a < n && prev[a] === cur[a]) a++;
+  while (b < n - a && prev[prev.length-1-b] === cur[cur.length-1-b]) b++;
+  return (a + b) * 2 >= Math.max(prev.length, cur.length);
+}
+
+function stopWatch(){
+  if (polling){ clearInterval(polling); polling = null; }
+  if (es){ es.close(); es = null; }
+  if (tick){ clearInterval(tick); tick = null; }
+}
+function finish(msg){
+  stopWatch(); jobId = null; last = null;
+  $("#statusLine").textContent = msg;
+  $("#runBtn").disabled = false;
+  $("#cancelBtn").style.display = "none";
+}
+// отменить текущую задачу на сервере (новый запуск её заменяет); keepalive — переживёт закрытие вкладки
+function cancelJob(){
+  if (!jobId) return;
+  const id = jobId;
+  stopWatch(); jobId = null; last = null;
+  fetch(`/jobs/${id}/cancel`, {method:"POST", keepalive:true}).catch(()=>{});
+}
+// между событиями сервера время и ETA тикают локально
+function tickLocal(){
+  if (!last) return;
+  const j = last.j, dt = (Date.now() - last.at)/1000;
+  setProgress(j.progress, j.done, j.total, Math.max(0, j.eta_sec - dt), j.elapsed_sec + dt);
+}
+
+async function onState(j){
+  last = {j, at: Date.now()};
+  setProgress(j.progress, j.done, j.total, j.eta_sec, j.elapsed_sec);
+  if (j.status === "cancelled") return finish("Отменено");
+  if (j.queue){
+    $("#statusLine").textContent = `В очереди: ${j.queue.pos}, старт через ~${fmtSec(j.queue.start_eta_sec)}`;
+  }else if (j.status === "loading"){
+    $("#statusLine").textContent = "Модель ещё загружается…";
+  }else if (!j.url){
+    $("#statusLine").textContent = "Синтез идёт…";
+  }
+  if (j.status === "interrupted"){
+    // сервер перезапускался: продолжаем с последнего готового блока
+    stopWatch();
+    $("#statusLine").textContent = "Сервер перезапущен, продолжаем…";
+    const rr = await fetch(`/jobs/${jobId}/resume?heartbeat=1`, {method:"POST"});
+    const jj = await rr.json();
+    if (!rr.ok) return finish("Ошибка: " + (jj.error || ("resume http "+rr.status)));
+    if (jj.stream) setStream(jj.stream);
+    watch();
+    return;
+  }
+  if (j.url){
+    setReady(j.url);
+    setChapters(j.chapters);
+    lastDone = runText ? {id: jobId, text: runText} : null;
+    const rv = j.revision;
+    finish(rv && rv.reused ? `Готово ✓ (из прошлой версии ${rv.reused} из ${j.total} блоков)` : "Готово ✓");
+  }
+}
+
+// id вкладки для честной очереди: живёт в sessionStorage, у каждой вкладки свой
+const CLIENT_ID = sessionStorage.getItem("t2v_client") || (()=>{
+  const id = (crypto.randomUUID ? crypto.randomUUID() : String(Math.random()).slice(2) + Date.now());
+  sessionStorage.setItem("t2v_client", id);
+  return id;
+})();
+function setChapters(list){
+  const box = $("#chapters");
+  box.innerHTML = "";
+  box.style.display = list && list.length ? "" : "none";
+  (list || []).forEach((c, n)=>{
+    const row = document.createElement("div");
+    const at = document.createElement("a");
+    at.href = "#";
+    at.textContent = `${fmtSec(c.start_sec)} — ${c.title || "Начало"}`;
+    at.onclick = (e)=>{ e.preventDefault(); const pl = $("#player"); pl.currentTime = c.start_sec; pl.play(); };
+    row.appendChild(at);
+    if (c.url){
+      const f = document.createElement("a");
+      f.href = c.url + "?download=1";
+      f.textContent = " ⬇";
+      row.appendChild(f);
+    }
+    box.appendChild(row);
+  });
+}
 
 async function poll(){
   if (!jobId) return;
   try{
     const r = await fetch(`/progress/${jobId}`);
-    if (!r.ok) throw new Error("progress http "+r.status);
     const j = await r.json();
-    setProgress(j.progress, j.done, j.total, j.eta_sec, j.elapsed_sec);
-    if (j.url){
-      setReady(j.url);
-      $("#statusLine").textContent = "Готово ✓";
-      clearInterval(polling); polling = null; jobId = null;
-      $("#runBtn").disabled = false;
-    }
+    if (r.status === 500 && j.error) return finish("Ошибка: " + j.error);
+    if (!r.ok) throw new Error("progress http "+r.status);
+    await onState(j);
   }catch(e){
     console.error(e);
     $("#statusLine").textContent = "Ошибка связи с сервером";
   }
 }
 
+// прогресс через SSE; если поток не поднялся или оборвался — опрос /progress
+function watch(){
+  stopWatch();
+  if (!window.EventSource){
+    polling = setInterval(poll, 600);
+    return;
+  }
+  es = new EventSource(`/events/${jobId}`);
+  es.addEventListener("progress", (e)=>onState(JSON.parse(e.data)));
+  es.addEventListener("failed", (e)=>finish("Ошибка: " + JSON.parse(e.data).error));
+  es.onerror = ()=>{
+    if (es){ es.close(); es = null; }
+    if (jobId && !polling) polling = setInterval(poll, 600);
+  };
+  tick = setInterval(tickLocal, 1000);
+}
+
 $("#runBtn").addEventListener("click", async ()=>{
   const text  = $("#text").value.trim();
   if (!text){ alert("Введите текст."); return; }
@@ -344,6 +1479,8 @@ $("#runBtn").addEventListener("click", async ()=>{
   const block = +$("#block").value || 360;
   const pause = +$("#pause").value || 120;
   const norm  = $("#norm").value === "1";
+  const fmt   = $("#fmt").value;
+  const kbps  = +$("#bitrate").value || 0;
 
   const fd = new FormData();
   fd.append("text", text);
@@ -351,25 +1488,37 @@ $("#runBtn").addEventListener("click", async ()=>{
   fd.append("block", String(block));
   fd.append("pause", String(pause));
   fd.append("norm",  norm ? "1" : "0");
+  fd.append("fmt",   fmt);
+  fd.append("longform", $("#longform").value);
+  fd.append("heartbeat", "1");     // страница опрашивает /events: без неё задача считается брошенной
+  if (lastDone && !$("#longform").value && isEditOf(lastDone.text, text)) fd.append("parent", lastDone.id);
+  runText = text;
+  setChapters(null);
+  if (kbps) fd.append("bitrate", String(kbps));
+  $("#download").textContent = "Скачать " + fmt.toUpperCase();
 
   const vfile = $("#voice").files[0];
   const recent = $("#recent") ? $("#recent").value : "";
   if (vfile) fd.append("voice_upload", vfile);
   else if (recent) fd.append("voice_choice", recent);
 
+  cancelJob();
   $("#runBtn").disabled = true;
   $("#statusLine").textContent = "Запуск синтеза…";
   setProgress(0, 0, 0, Infinity, 0);
   $("#result").style.display = "none";
 
   try{
-    const r = await fetch("/synthesize", {method:"POST", body: fd});
+    const r = await fetch("/synthesize", {method:"POST", body: fd, headers: {"X-Client-Id": CLIENT_ID}});
     const j = await r.json();
+    if (r.status === 429) throw new Error(`${j.error} (через ~${fmtSec(j.retry_after)})`);
     if (!r.ok) throw new Error(j.error || ("http "+r.status));
     jobId = j.job_id;
     $("#statusLine").textContent = "Синтез идёт…";
-    if (polling) clearInterval(polling);
-    polling = setInterval(poll, 600);
+    $("#runBtn").disabled = false;          // новый запуск отменит этот
+    $("#cancelBtn").style.display = "";
+    setStream(j.stream);
+    watch();
   }catch(e){
     console.error(e);
     alert("Ошибка: " + e.message);
@@ -377,6 +1526,12 @@ $("#runBtn").addEventListener("click", async ()=>{
   }
 });
 
+$("#cancelBtn").addEventListener("click", ()=>{ cancelJob(); finish("Отменено"); });
+// вкладку закрыли или перезагрузили — работу останавливаем, чекпоинт сервер сохранит для продолжения
+window.addEventListener("pagehide", ()=>{
+  if (jobId && navigator.sendBeacon) navigator.sendBeacon(`/jobs/${jobId}/cancel?reason=abandoned`);
+});
+
 // тема
 $("#themeBtn").addEventListener("click", ()=>{
   const root = document.documentElement;
@@ -388,64 +1543,1151 @@ $("#themeBtn").addEventListener("click", ()=>{
 </html>
 """
 
-def do_synth(job_id: str, text: str, lang: str, voice_path: Path, block_len: int, pause_ms: int):
+# ---- потоковая отдача ----
+# Готовые блоки публикуются в PROGRESS[job_id]["stream"] (BlockStream: массив или путь .npy
+# чекпоинта/spill), /stream/<job_id> отдаёт их как WAV «бесконечной» длины, не дожидаясь конца задачи.
+_JOB_COND = threading.Condition()
+_JOB_VER = 0        # растёт на каждое изменение состояния задач (для /events без потерянных пробуждений)
+
+class BlockStream:
+    """
+    Готовые блоки задачи для открытых /stream. Пути .npy хранятся все (поздний слушатель
+    начнёт с первого блока); массивы — только пока их не прочли все открытые /stream,
+    а без слушателей — не больше STREAM_BACKLOG последних, так что память не растёт с длиной задачи.
+    Поздний слушатель в этом режиме начинает с самого старого блока, что ещё в памяти.
     """
-    Фоновая сборка итогового WAV: блоки -> tts_to_file -> склейка pydub (+тихие паузы).
+    def __init__(self):
+        self.items: List[object] = []
+        self.base = 0                       # номер блока items[0]
+        self.readers: Dict[int, int] = {}   # слушатель -> номер следующего блока
+        self._next_id = 0
+
+    def append(self, item):
+        with _JOB_COND:
+            self.items.append(item)
+            self._trim()
+
+    def open(self) -> int:
+        with _JOB_COND:
+            self._next_id += 1
+            self.readers[self._next_id] = self.base
+            return self._next_id
+
+    def close(self, rid: int) -> int:
+        # -> сколько слушателей осталось
+        with _JOB_COND:
+            self.readers.pop(rid, None)
+            self._trim()
+            return len(self.readers)
+
+    def next(self, rid: int):
+        # следующий блок для слушателя или None, если его ещё нет
+        with _JOB_COND:
+            i = max(self.readers[rid], self.base)
+            if i - self.base >= len(self.items):
+                return None
+            self.readers[rid] = i + 1
+            item = self.items[i - self.base]
+            self._trim()
+            return item
+
+    def _trim(self):
+        if not self.items or isinstance(self.items[0], Path):
+            return
+        end = self.base + len(self.items)
+        keep = min(self.readers.values()) if self.readers else end - STREAM_BACKLOG
+        n = min(max(0, keep - self.base), len(self.items))
+        if n:
+            del self.items[:n]
+            self.base += n
+
+def notify_jobs():
+    global _JOB_VER
+    with _JOB_COND:
+        _JOB_VER += 1
+        _JOB_COND.notify_all()
+
+def wait_jobs(seen: int, timeout: float) -> int:
+    """
+    Ждёт изменения состояния после версии seen; возвращает текущую версию.
+    """
+    with _JOB_COND:
+        if _JOB_VER == seen:
+            _JOB_COND.wait(timeout=timeout)
+        return _JOB_VER
+
+def pcm16(a: np.ndarray) -> bytes:
+    return (np.clip(a, -1.0, 1.0) * 32767.0).astype("<i2").tobytes()
+
+def wav_stream_header(sr: int = OUT_SR) -> bytes:
+    """
+    Заголовок PCM16/mono WAV с открытой длиной (0xFFFFFFFF) — плееры играют до конца потока.
+    """
+    return (
+        b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, sr, sr * 2, 2, 16)
+        + b"data" + struct.pack("<I", 0xFFFFFFFF)
+    )
+
+# ---- планировщик задач ----
+class QueueFull(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("queue full")
+        self.retry_after = retry_after
+
+class JobCancelled(Exception):
+    """
+    Задачу отменили (пользователь или никто её больше не ждёт); причина — в тексте.
+    """
+
+class Scheduler:
+    """
+    Ограниченная очередь задач вместо потока на каждый POST.
+    - задачи ждут в очередях по клиентам, JOB_RUNNERS раннеров берут их по кругу;
+    - модель выдаётся слотами (INFER_WORKERS) на один блок, тоже по кругу между клиентами,
+      так что огромный текст не держит модель, пока ждут короткие.
+    """
+    def __init__(self, runners: int, slots: int, max_queue: int):
+        self.max_queue = max_queue
+        self.slots = max(1, slots)
+        self.rate = 18.0                    # общий EMA символов/с на один слот
+        self._cv = threading.Condition()
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._queued = 0
+        self._active: Dict[str, str] = {}   # job_id -> client
+        self._free = self.slots
+        self._waiters: "OrderedDict[str, deque]" = OrderedDict()
+        for n in range(max(1, runners)):
+            threading.Thread(target=self._runner, name=f"t2v-runner-{n}", daemon=True).start()
+
+    def submit(self, client: str, job_id: str, fn, *args):
+        with self._cv:
+            if self._queued >= self.max_queue:
+                raise QueueFull(self.retry_after())
+            self._queues.setdefault(client, deque()).append((job_id, fn, args, time.time()))
+            self._queued += 1
+            self._cv.notify_all()
+
+    def _runner(self):
+        while True:
+            with self._cv:
+                while not self._queued:
+                    self._cv.wait()
+                client, q = next(iter(self._queues.items()))
+                job_id, fn, args, t_sub = q.popleft()
+                del self._queues[client]
+                if q:
+                    self._queues[client] = q     # клиент уходит в конец круга
+                self._queued -= 1
+                self._active[job_id] = client
+            wait = time.time() - t_sub
+            QUEUE_WAIT.observe(wait)
+            if job_id in PROGRESS:
+                PROGRESS[job_id].setdefault("stages", {})["queue_wait"] = wait
+            notify_jobs()       # сдвинулись позиции в очереди
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"[sched] job {job_id} crashed: {e}")
+            finally:
+                with self._cv:
+                    self._active.pop(job_id, None)
+                    self._cv.notify_all()
+
+    def acquire(self, job_id: str):
+        """
+        Слот модели на один блок; при конкуренции выдаётся клиентам по очереди.
+        """
+        with self._cv:
+            client = self._active.get(job_id, job_id)
+            if self._free > 0 and not self._waiters:
+                self._free -= 1
+                return
+            ticket = [False]
+            self._waiters.setdefault(client, deque()).append(ticket)
+            while not ticket[0]:
+                reason = (PROGRESS.get(job_id) or {}).get("cancel")
+                if reason:
+                    q = deque(t for t in self._waiters[client] if t is not ticket)
+                    if q:
+                        self._waiters[client] = q
+                    else:
+                        del self._waiters[client]
+                    raise JobCancelled(reason)
+                self._cv.wait()
+
+    def release(self):
+        with self._cv:
+            if self._waiters:
+                c, q = next(iter(self._waiters.items()))
+                q.popleft()[0] = True
+                del self._waiters[c]
+                if q:
+                    self._waiters[c] = q
+            else:
+                self._free += 1
+            self._cv.notify_all()
+
+    def drop(self, job_id: str) -> bool:
+        """
+        Убирает задачу из очереди (True), если раннер её ещё не взял.
+        """
+        with self._cv:
+            for client, q in list(self._queues.items()):
+                keep = deque(x for x in q if x[0] != job_id)
+                if len(keep) == len(q):
+                    continue
+                self._queued -= len(q) - len(keep)
+                if keep:
+                    self._queues[client] = keep
+                else:
+                    del self._queues[client]
+                self._cv.notify_all()
+                return True
+            return False
+
+    def wake(self):
+        # ждущие слот проверят отмену
+        with self._cv:
+            self._cv.notify_all()
+
+    @contextmanager
+    def slot(self, job_id: str):
+        self.acquire(job_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def observe_rate(self, rate_now: float):
+        self.rate = 0.90 * self.rate + 0.10 * rate_now
+
+    def _order(self) -> List[str]:
+        # порядок, в котором раннеры будут брать задачи (round-robin по клиентам)
+        qs = [list(q) for q in self._queues.values()]
+        out: List[str] = []
+        for i in range(max((len(q) for q in qs), default=0)):
+            out += [q[i][0] for q in qs if i < len(q)]
+        return out
+
+    def _remaining_chars(self, job_id: str) -> float:
+        p = PROGRESS.get(job_id) or {}
+        total = float(p.get("total_chars") or p.get("queued_chars") or 0)
+        return max(0.0, total - float(p.get("chars_done") or 0))
+
+    def retry_after(self) -> int:
+        # когда освободится ближайший раннер: активные делят слоты поровну
+        rem = [self._remaining_chars(j) for j in self._active]
+        if not rem:
+            return 1
+        return int(max(1.0, min(rem) * len(rem) / (self.rate * self.slots)))
+
+    def queue_info(self, job_id: str) -> Optional[Dict]:
+        """
+        Позиция в очереди (1 — следующая) и оценка времени до старта.
+        """
+        with self._cv:
+            order = self._order()
+            if job_id not in order:
+                return None
+            pos = order.index(job_id)
+            ahead = sum(self._remaining_chars(j) for j in self._active)
+            ahead += sum(self._remaining_chars(j) for j in order[:pos])
+            return {"pos": pos + 1, "start_eta_sec": ahead / (self.rate * self.slots)}
+
+SCHED = Scheduler(JOB_RUNNERS, INFER_WORKERS, MAX_QUEUE)
+
+Gauge("t2v_active_jobs", "Jobs currently running", lambda: len(SCHED._active))
+Gauge("t2v_queued_jobs", "Jobs waiting in the scheduler queue", lambda: SCHED._queued)
+Gauge("t2v_model_ready", "1 when the model is loaded and warmed up", lambda: int(MODEL_STATE["phase"] == "ready"))
+Gauge("t2v_model_memory_bytes", "Model parameters and buffers, all replicas", lambda: MODEL_STATE.get("model_bytes"))
+Gauge("t2v_block_cache_bytes", "Size of the on-disk block cache", lambda: BLOCK_CACHE.stats["size_bytes"])
+
+def client_key() -> str:
+    # X-Client-Id — лишь подсказка для чередования в очереди (UI шлёт id вкладки),
+    # не идентификация: клиент может прислать любое значение
+    return request.headers.get("X-Client-Id") or request.remote_addr or "?"
+
+def new_progress() -> Dict:
+    return dict(
+        done_blocks=0, total_blocks=0,
+        chars_done=0, total_chars=0,
+        cur_block_len=0, cur_block_started=None,
+        ema_rate=18.0, url=None, error=None,
+        job_started=time.time(),
+        stream=BlockStream(), finished=False,
+        cache_hits=0, cache_misses=0, cache_bytes_saved=0,
+        stages={}, audio_sec=0.0, infer_audio_sec=0.0,
+        status="queued",
+    )
+
+# ---- чекпоинты задач ----
+_JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+def _write_json(path: Path, data: Dict):
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _read_json(path: Path) -> Optional[Dict]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+class JobCheckpoint:
+    """
+    Состояние задачи на диске, JOBS_DIR/<job_id>/:
+      job.json    — параметры, исходный текст и имя итогового файла (пишется при постановке в очередь);
+      blocks.json — список блоков (один раз, при старте);
+      chapters.json — главы длинной формы: [{title, block}];
+      revision.json — ревизия: {parent, reuse: {номер блока: номер блока родителя}};
+      state.json  — статус и число готовых блоков (после каждого блока);
+      NNNN.npy    — аудио готовых блоков; после успеха удаляются, когда закрылся последний /stream.
+    Сам каталог удаляет purge_jobs через JOB_KEEP_SEC (JOB_STALE_SEC для прерванных).
+    """
+    def __init__(self, job_id: str):
+        self.dir = JOBS_DIR / job_id
+
+    @staticmethod
+    def exists(job_id: str) -> bool:
+        return bool(_JOB_ID.fullmatch(job_id)) and (JOBS_DIR / job_id / "job.json").exists()
+
+    def create(self, params: Dict):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        _write_json(self.dir / "job.json", dict(params, created=time.time()))
+        self.set_state(status="queued", done=0)
+
+    def params(self) -> Optional[Dict]:
+        return _read_json(self.dir / "job.json")
+
+    def out_name(self, ext: str) -> str:
+        # имя итогового файла выбирается один раз: продолжение после рестарта пишет туда же
+        prm = self.params() or {}
+        if not prm.get("out"):
+            prm["out"] = f"{uuid.uuid4().hex}.{ext}"
+            _write_json(self.dir / "job.json", prm)
+        return prm["out"]
+
+    def state(self) -> Dict:
+        return _read_json(self.dir / "state.json") or {}
+
+    def set_state(self, **kw):
+        st = self.state()
+        st.update(kw, updated=time.time())
+        _write_json(self.dir / "state.json", st)
+
+    def blocks(self) -> Optional[List[str]]:
+        return _read_json(self.dir / "blocks.json")
+
+    def save_blocks(self, blocks: List[str]):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        _write_json(self.dir / "blocks.json", blocks)
+
+    def chapters(self) -> Optional[List[Dict]]:
+        return _read_json(self.dir / "chapters.json")
+
+    def save_chapters(self, chapters: List[Dict]):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        _write_json(self.dir / "chapters.json", chapters)
+
+    def revision(self) -> Optional[Dict]:
+        return _read_json(self.dir / "revision.json")
+
+    def save_revision(self, rev: Dict):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        _write_json(self.dir / "revision.json", rev)
+
+    def block_path(self, i: int) -> Path:
+        return self.dir / f"{i:04d}.npy"
+
+    def save_block(self, i: int, a: np.ndarray) -> Path:
+        path = self.block_path(i)
+        tmp = self.dir / f"{i:04d}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, a)
+        os.replace(tmp, path)
+        self.set_state(status="running", done=i)
+        return path
+
+    def done_count(self) -> int:
+        # готовы блоки 1..N без дыр (state.json мог не успеть записаться)
+        n = 0
+        while self.block_path(n + 1).exists():
+            n += 1
+        return n
+
+    def finish(self, url: str, **kw):
+        # блоки остаются, пока открытые /stream их дочитывают; удаляет purge_blocks за последним
+        self.set_state(status="done", url=url, **kw)
+
+    def purge_blocks(self):
+        for f in self.dir.glob("*.npy"):
+            try: f.unlink()
+            except OSError: pass
+
+def restore_job(job_id: str) -> Optional[Dict]:
+    """
+    Запись PROGRESS по чекпоинту (после рестарта): готовые — с url, прочие — interrupted.
+    """
+    if not CHECKPOINT_JOBS or not JobCheckpoint.exists(job_id):
+        return None
+    ck = JobCheckpoint(job_id)
+    st, blocks = ck.state(), ck.blocks() or []
+    done = ck.done_count() if st.get("status") != "done" else len(blocks)
+    p = new_progress()
+    p.update(
+        total_blocks=len(blocks), done_blocks=done,
+        total_chars=sum(len(b) for b in blocks), chars_done=sum(len(b) for b in blocks[:done]),
+        url=st.get("url"), error=st.get("error"), chapters=st.get("chapters"),
+        status=st.get("status") if st.get("status") in ("done", "error") else "interrupted",
+        finished=True, finished_at=time.time(),
+    )
+    PROGRESS[job_id] = p
+    return p
+
+def find_job(job_id: str) -> Optional[Dict]:
+    return PROGRESS.get(job_id) or restore_job(job_id)
+
+def purge_jobs():
+    """
+    Чистка JOBS_DIR: каталог удаляется целиком, если задача завершилась или упала
+    больше JOB_KEEP_SEC назад, либо прервана и не обновлялась JOB_STALE_SEC. Идущие не трогаем.
+    """
+    now = time.time()
+    for d in list(JOBS_DIR.iterdir()):
+        if not d.is_dir():
+            continue
+        p = PROGRESS.get(d.name)
+        if p and not p.get("finished"):
+            continue
+        st = JobCheckpoint(d.name).state()
+        ttl = JOB_KEEP_SEC if st.get("status") in ("done", "error") else JOB_STALE_SEC
+        try:
+            age = now - float(st.get("updated") or d.stat().st_mtime)
+        except OSError:
+            continue
+        if age > ttl:
+            shutil.rmtree(d, ignore_errors=True)
+# ---- ревизии задач ----
+# Исправили опечатку и отправили текст снова (parent=<job_id> прошлой версии): блоки, чьи слова
+# не изменились, берутся из аудио родителя, в модель идут только вставленные и изменённые.
+def audio_tag() -> str:
+    # от этого зависит аудио блока, кроме текста, голоса и языка
+    return f"{BLOCK_CACHE.version};{BLOCK_CACHE.params}"
+
+def _word_units(words: List[str], lo: int, hi: int) -> List[Tuple[int, int]]:
+    out, start = [], lo
+    for i in range(lo, hi):
+        w = words[i]
+        if w[-1] in ".!?…" or zlib.crc32(w.encode()) % 12 == 0:
+            out.append((start, i + 1))
+            start = i + 1
+    if start < hi:
+        out.append((start, hi))
+    return out
+
+def revise_blocks(old: List[str], txt: str, max_len: int, lang: str) -> Tuple[List[str], Dict[int, int]]:
+    """
+    Блоки новой версии текста относительно блоков старой. Сравнение по словам (difflib):
+    старый блок, целиком лежащий в совпавшем отрезке, переходит как есть, текст между
+    такими блоками заново режется split_into_blocks. Возвращает (блоки, {новый номер: старый}),
+    номера с 1, как у чекпоинта. Сплиттер балансирует блоки по всему тексту, поэтому простое
+    повторное разбиение сдвинуло бы границы всех блоков после правки.
+    """
+    old_words: List[str] = []
+    spans = []                                  # (первое слово, конец) старого блока
+    for b in old:
+        w = b.split()
+        spans.append((len(old_words), len(old_words) + len(w)))
+        old_words += w
+    new_words = txt.split()
+
+    # общие начало и конец — без difflib, он нужен только для середины
+    n0 = 0
+    lim = min(len(old_words), len(new_words))
+    while n0 < lim and old_words[n0] == new_words[n0]:
+        n0 += 1
+    n1 = 0
+    while n1 < lim - n0 and old_words[-1 - n1] == new_words[-1 - n1]:
+        n1 += 1
+    # середину сравниваем кусками по несколько слов (граница — конец фразы или слово с «редким» хэшем,
+    # так куски после вставки снова совпадают): пословный difflib на книге занимает секунды
+    uo, un = _word_units(old_words, n0, len(old_words) - n1), _word_units(new_words, n0, len(new_words) - n1)
+    sm = difflib.SequenceMatcher(None, [" ".join(old_words[x:y]) for x, y in uo],
+                                 [" ".join(new_words[x:y]) for x, y in un], autojunk=False)
+    equal = [(0, 0, n0)]
+    equal += [(uo[a][0], un[b][0], uo[a + n - 1][1] - uo[a][0]) for a, b, n in sm.get_matching_blocks() if n]
+    equal.append((len(old_words) - n1, len(new_words) - n1, n1))
+    merged = []                                 # стыкующиеся отрезки — в один, иначе блок на стыке потеряется
+    for a, b, n in equal:
+        if merged and merged[-1][0] + merged[-1][2] == a and merged[-1][1] + merged[-1][2] == b:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + n)
+        elif n:
+            merged.append((a, b, n))
+
+    kept = []                                   # (начало, конец в новых словах, старый номер)
+    k = 0
+    for a, b, n in merged:
+        while k < len(spans) and spans[k][0] < a:
+            k += 1
+        while k < len(spans) and spans[k][1] <= a + n:
+            s0, s1 = spans[k]
+            if s1 > s0:
+                kept.append((b + s0 - a, b + s1 - a, k + 1))
+            k += 1
+
+    blocks: List[str] = []
+    reuse: Dict[int, int] = {}
+    pos = 0
+    for s0, s1, k in kept + [(len(new_words), len(new_words), 0)]:
+        if s0 > pos:
+            blocks += split_into_blocks(" ".join(new_words[pos:s0]), max_len=max_len, lang=lang)
+        if k:
+            blocks.append(old[k - 1])
+            reuse[len(blocks)] = k
+        pos = s1
+    return blocks, reuse
+
+def parent_audio(parent: str, voice_path: Path, lang: str, block_len: int):
+    """
+    (блоки, load(номер) -> аудио | None) завершённой задачи-родителя: NNNN.npy чекпоинта,
+    пока их не вычистили, иначе отрезок итогового WAV/FLAC по spans из state.json.
+    None — переиспользовать нечего: нет чекпоинта, другой голос, язык, размер блока,
+    лимит токенов или параметры аудио (старые блоки не совпали бы с новой нарезкой).
+    """
+    if not CHECKPOINT_JOBS or not parent or not JobCheckpoint.exists(parent):
+        return None
+    ck = JobCheckpoint(parent)
+    prm, st = ck.params() or {}, ck.state()
+    if (st.get("status") != "done" or prm.get("longform") or prm.get("voice") != str(voice_path)
+            or prm.get("lang") != lang or st.get("audio") != audio_tag()
+            or prm.get("block_len") != block_len or st.get("token_limit") != TOKEN_LIMIT):
+        return None
+    blocks = ck.blocks() or []
+    spans = st.get("spans") or []
+    out = OUT_DIR / (st.get("url") or "-")
+    seekable = out.suffix in (".wav", ".flac") and len(spans) == len(blocks)
+
+    def load(k: int) -> Optional[np.ndarray]:
+        try:
+            if ck.block_path(k).exists():
+                return np.load(str(ck.block_path(k)))
+            if seekable and out.is_file():
+                start, n = spans[k - 1]
+                a, _ = sf.read(str(out), start=start, frames=n, dtype="float32", always_2d=True)
+                return np.ascontiguousarray(a[:, 0])
+        except Exception as e:
+            print(f"[jobs] parent {parent} block {k} unavailable: {e}")
+        return None
+
+    return blocks, load
+
+def _drop_shared(fut):
+    if not fut.cancelled() and fut.exception() is None:
+        take_shared(fut.result())
+
+# ---- конвейер ----
+# Стадии блока: инференс -> постобработка (POST_POOL) -> запись (Stage в do_synth).
+# Пока модель считает блок i+1, блок i ресемплится/нормализуется, а i-1 кодируется и пишется.
+POST_POOL = ThreadPoolExecutor(max(1, POST_WORKERS), thread_name_prefix="t2v-post")
+_STOP = object()
+
+class Stage:
+    """
+    Стадия конвейера в своём потоке: fn(item) для каждого элемента ограниченной очереди.
+    put() ждёт, когда стадия отстаёт на depth элементов; ошибка стадии всплывает в put()/close().
+    """
+    def __init__(self, name: str, fn, depth: int = PIPE_DEPTH):
+        self.fn = fn
+        self.q: "queue.Queue" = queue.Queue(maxsize=max(1, depth))
+        self.err: Optional[BaseException] = None
+        self._t = threading.Thread(target=self._run, name=name, daemon=True)
+        self._t.start()
+
+    def _run(self):
+        while True:
+            item = self.q.get()
+            if item is _STOP:
+                return
+            if self.err is None:        # после ошибки только вычерпываем очередь
+                try:
+                    self.fn(item)
+                except BaseException as e:
+                    self.err = e
+
+    def put(self, item):
+        if self.err is not None:
+            raise self.err
+        self.q.put(item)
+
+    def depth(self) -> int:
+        return self.q.qsize()
+
+    def close(self, reraise: bool = True):
+        self.q.put(_STOP)
+        self._t.join()
+        if reraise and self.err is not None:
+            raise self.err
+
+def synth_blocks(job_id: str, blocks: List[str], lang: str, voice_path: Path, start: int = 0, reuse=None):
+    """
+    Движок синтеза: отдаёт (номер, текст, аудио 24k, сек. инференса) строго по порядку блоков.
+    Сначала reuse(номер) — аудио прошлой ревизии, затем BLOCK_CACHE (сек. = None), промахи идут в модель:
+    thread — последовательно в этом процессе; procs — параллельно по процессам пула,
+    в полёте не больше, чем даёт планировщик слотов.
+    Постобработка (block_audio) идёт в POST_POOL параллельно со следующим инференсом.
+    """
+    p = PROGRESS[job_id]
+    vkey = file_digest(voice_path)
+    ckeys = [BLOCK_CACHE.key(b, vkey, lang) for b in blocks]
+    todo = list(enumerate(blocks, 1))[start:]
+
+    def started(b: str):
+        p["cur_block_len"] = len(b)
+        p["cur_block_started"] = time.time()
+
+    def post(i: int, w, sr: int) -> np.ndarray:
+        t = time.perf_counter()
+        a = block_audio(w, sr)
+        BLOCK_CACHE.put(ckeys[i - 1], a)
+        add_stage(p, "post", time.perf_counter() - t)
+        return a
+
+    def cached(i: int) -> Optional[np.ndarray]:
+        a = reuse(i) if reuse else None
+        if a is not None:
+            return a
+        a = BLOCK_CACHE.get(ckeys[i - 1])
+        p["cache_hits" if a is not None else "cache_misses"] += 1
+        if a is not None:
+            p["cache_bytes_saved"] += a.nbytes
+            CACHE_SAVED.inc(a.nbytes)
+        return a
+
+    if ENGINE != "procs":
+        lat = None
+        sr = 0
+        posting: deque = deque()     # (номер, текст, future постобработки | аудио из кэша, сек.)
+
+        def ready(force: bool):
+            while posting and (force or len(posting) > PIPE_DEPTH or not isinstance(posting[0][2], Future)
+                               or posting[0][2].done()):
+                i, b, x, dt = posting.popleft()
+                p["post_queue"] = len(posting)
+                yield i, b, x.result() if isinstance(x, Future) else x, dt
+
+        for i, b in todo:
+            check_cancel(p)
+            a = cached(i)
+            if a is not None:
+                posting.append((i, b, a, None))
+                yield from ready(False)
+                continue
+            started(b)
+            if lat is None:
+                # модель и латенты нужны только при первом промахе кэша блоков
+                if not _MODEL_READY.is_set():
+                    p["status"] = "loading"
+                with timed(p, "model_wait"):
+                    wait_model()
+                p["status"] = "running"
+                with SCHED.slot(job_id):
+                    t_lat = time.time()
+                    gpt, spk, lat_src = voice_latents(voice_path)
+                    p.update(latent_src=lat_src, latent_sec=time.time() - t_lat)
+                    add_stage(p, "latents", p["latent_sec"])
+                lat = (gpt, spk)
+                sr = int(TTS_MODEL.synthesizer.output_sample_rate)
+            with SCHED.slot(job_id):
+                t1 = time.time()
+                wav = infer_block(b, lang, *lat, p)
+                dt = time.time() - t1
+            posting.append((i, b, POST_POOL.submit(post, i, wav, sr), dt))
+            p["post_queue"] = len(posting)
+            yield from ready(False)
+        yield from ready(True)
+        p["cur_block_len"] = 0
+        p["cur_block_started"] = None
+        return
+
+    pool = None
+    latent_path = LATENT_DIR / f"{vkey}{LATENT_TAG}.pt"
+    pending: deque = deque()     # (номер, текст, future | готовое аудио из кэша)
+
+    def head():
+        i, b, fut = pending.popleft()
+        if isinstance(fut, np.ndarray):
+            return i, b, fut, None
+        w, sr, sec, src = take_shared(fut.result())
+        if not p.get("latent_src"):
+            p.update(latent_src=src, latent_sec=0.0)
+        for _, nb, nf in pending:
+            if not isinstance(nf, np.ndarray):
+                started(nb)
+                break
+        return i, b, post(i, w, sr), sec
+
+    try:
+        for i, b in todo:
+            check_cancel(p)
+            a = cached(i)
+            if a is not None:
+                pending.append((i, b, a))
+            else:
+                if pool is None:
+                    if not _MODEL_READY.is_set():
+                        p["status"] = "loading"
+                    with timed(p, "model_wait"):
+                        wait_model()
+                    p["status"] = "running"
+                    pool = get_pool()
+                SCHED.acquire(job_id)
+                try:
+                    fut = pool.submit(b, lang, voice_path, vkey, latent_path)
+                except Exception:
+                    SCHED.release()
+                    raise
+                fut.add_done_callback(lambda f: SCHED.release())
+                if all(isinstance(x[2], np.ndarray) for x in pending):
+                    started(b)
+                pending.append((i, b, fut))
+            while pending and (isinstance(pending[0][2], np.ndarray) or pending[0][2].done()):
+                yield head()
+        while pending:
+            yield head()
+    finally:
+        # задача прервана: недоделанные блоки отменяем, уже посчитанные — освобождаем
+        for _, _, fut in pending:
+            if not isinstance(fut, np.ndarray) and not fut.cancel():
+                fut.add_done_callback(_drop_shared)
+        p["cur_block_len"] = 0
+        p["cur_block_started"] = None
+
+def block_done(p: Dict, b: str, dt: Optional[float], last_t: float, samples: int = 0) -> float:
+    """
+    Учёт готового блока. ETA задачи — по реальному темпу выдачи блоков (в procs блоки идут
+    параллельно), планировщику — чистая скорость одного слота. Блоки из кэша (dt=None) темп не трогают.
+    """
+    now = time.time()
+    audio_sec = samples / OUT_SR
+    p["audio_sec"] = p.get("audio_sec", 0.0) + audio_sec
+    if dt is not None:
+        rate_now = len(b) / max(0.001, now - last_t)
+        ema = p.get("ema_rate", 18.0)
+        p["ema_rate"] = 0.80 * ema + 0.20 * rate_now
+        SCHED.observe_rate(len(b) / max(0.001, dt))
+        add_stage(p, "infer", dt)
+        p["infer_audio_sec"] = p.get("infer_audio_sec", 0.0) + audio_sec
+        if audio_sec:
+            BLOCK_RTF.observe(dt / audio_sec)
+    BLOCKS_TOTAL.inc(source="cache" if dt is None else "model")
+    p["done_blocks"] += 1
+    p["chars_done"]  += len(b)
+    notify_jobs()
+    return now
+
+def do_synth(job_id: str, text: str, lang: str, voice_path: Path, block_len: int, pause_ms: int,
+             fmt: str = "wav", bitrate: int = 0, profile: str = "", longform: str = "",
+             out: Optional[Path] = None, parent: str = ""):
+    """
+    Фоновый синтез: латенты эталона (кэш) -> блоки (numpy) -> сразу в итоговый файл
+    (BookWriter, WAV/FLAC/Opus/MP3) с тихими паузами между блоками.
     Обновляет PROGRESS[job_id] на каждом шаге, чтобы фронт показывал проценты и ETA.
+    С чекпоинтом каждый блок сохраняется в JOBS_DIR, и повторный запуск продолжает с места остановки.
+    longform — длинная форма: главы по заголовкам, "markers" — .cue, "files" — ещё и файл на главу;
+    блоки для /stream в памяти не копятся. profile — прогон под профилировщиком (run_profiled).
+    out — куда писать вместо OUT_DIR/<uuid>; p["stream"] = None — без /stream (CLI).
+    parent — прошлая версия задачи (ревизия): неизменённые блоки берутся из её аудио.
     """
+    if profile:
+        return run_profiled(job_id, profile, do_synth, job_id, text, lang, voice_path, block_len, pause_ms,
+                            fmt, bitrate, "", longform, out, parent)
+    p = PROGRESS[job_id]
+    ck = JobCheckpoint(job_id) if CHECKPOINT_JOBS else None
+    writer: Optional[BookWriter] = None
     try:
         t0 = time.time()
-        txt = normalize_text(text, hard=True)
-        blocks = split_into_blocks(txt, max_len=block_len)
-        PROGRESS[job_id].update(
+        blocks = ck.blocks() if ck else None
+        chapters = (ck.chapters() if ck else None) or []
+        src = parent_audio(parent, voice_path, lang, block_len) if parent and not longform else None
+        reuse_map: Dict[int, int] = {}
+        if blocks is not None and src:
+            reuse_map = {int(k): v for k, v in ((ck.revision() or {}).get("reuse") or {}).items()}
+        if blocks is None:
+            blocks, chapters = [], []
+            for title, body in (split_chapters(text) if longform else []) or [("", text)]:
+                if title:
+                    # заголовок читается отдельной фразой в начале главы
+                    body = f"{title.rstrip('.:;!?…')}. {body}"
+                    chapters.append(dict(title=title, block=len(blocks)))
+                elif longform and blocks == []:
+                    chapters.append(dict(title="", block=0))
+                with timed(p, "normalize"):
+                    txt = normalize_text(body, hard=True)
+                with timed(p, "split"):
+                    if src:
+                        blocks, reuse_map = revise_blocks(src[0], txt, block_len, lang)
+                    else:
+                        blocks += split_into_blocks(txt, max_len=block_len, lang=lang)
+            if len(chapters) < 2:
+                chapters = []
+            if ck:
+                ck.save_blocks(blocks)
+                ck.save_chapters(chapters)
+                if src:
+                    ck.save_revision(dict(parent=parent, reuse=reuse_map))
+        rev = p["revision"] = dict(parent=parent, reused=len(reuse_map), resynth=len(blocks) - len(reuse_map)) \
+            if parent else None
+
+        def reused(i: int) -> Optional[np.ndarray]:
+            k = reuse_map.get(i)
+            a = src[1](k) if k else None
+            if k and a is None:         # аудио родителя уже нет — блок пойдёт в модель
+                rev["reused"] -= 1
+                rev["resynth"] += 1
+            return a
+
+        done = ck.done_count() if ck else 0
+        p.update(
             total_blocks=len(blocks),
             total_chars=sum(len(b) for b in blocks),
-            job_started=t0
+            done_blocks=done,
+            chars_done=sum(len(b) for b in blocks[:done]),
+            resumed_from=done,
+            job_started=t0,
+            status="running",
         )
 
-        tmp_files: List[Path] = []
-        for i, b in enumerate(blocks, 1):
-            PROGRESS[job_id]["cur_block_len"] = len(b)
-            PROGRESS[job_id]["cur_block_started"] = time.time()
+        ext = OUT_FORMATS[fmt][0]
+        out_path = OUT_DIR / (ck.out_name(ext) if ck else f"{uuid.uuid4().hex}.{ext}")
+        out_path = out or OUT_DIR / f"{uuid.uuid4().hex}.{OUT_FORMATS[fmt][0]}"
+        writer = BookWriter(out_path, fmt, bitrate, pause_ms, chapters, per_chapter=longform == "files")
+        # /stream читает блоки с диска (чекпоинт или TMP), а не из списка массивов
+        streaming = p["stream"] is not None
+        spill = (SPILL_TO_DISK or bool(longform)) and streaming
+        spilled: List[Path] = []
+        spans: List[Tuple[int, int]] = []      # (первый сэмпл, длина) блока в итоговом файле — для ревизий
+        for i in range(1, done + 1):
+            a = np.load(str(ck.block_path(i)))
+            spans.append((writer.main.frames, int(a.size)))
+            with timed(p, "encode"):
+                writer.write_block(i - 1, a)
+            if streaming:
+                p["stream"].append(ck.block_path(i))
+        if done:
+            notify_jobs()
+
+        last_t = time.time()
+
+        def write(item):
+            # стадия записи (свой поток): чекпоинт, файл, /stream, прогресс
+            nonlocal last_t
+            i, b, a, dt = item
+            path = None
+            if ck:
+                with timed(p, "checkpoint"):
+                    path = ck.save_block(i, a)
+            elif spill:
+                path = TMP_DIR / f"{job_id}_{i:04d}.npy"
+                np.save(str(path), a)
+                spilled.append(path)
+            spans.append((writer.main.frames, int(a.size)))
+            with timed(p, "encode"):
+                writer.write_block(i - 1, a)
+            if streaming:
+                p["stream"].append(path if path is not None else a)
+            last_t = block_done(p, b, dt, last_t, a.size)
 
-            tmp_wav = TMP_DIR / f"{job_id}_{i:04d}.wav"
-            # Сам tts:
-            t1 = time.time()
-            TTS_MODEL.tts_to_file(text=b, speaker_wav=str(voice_path), language=lang, file_path=str(tmp_wav))
-            t2 = time.time()
-
-            dt = max(0.001, t2 - t1)
-            rate_now = len(b) / dt
-            ema = PROGRESS[job_id].get("ema_rate", 18.0)
-            PROGRESS[job_id]["ema_rate"] = 0.80 * ema + 0.20 * rate_now
-
-            tmp_files.append(tmp_wav)
-            PROGRESS[job_id]["done_blocks"] += 1
-            PROGRESS[job_id]["chars_done"]  += len(b)
-            PROGRESS[job_id]["cur_block_len"] = 0
-            PROGRESS[job_id]["cur_block_started"] = None
-
-        final = AudioSegment.silent(duration=0)
-        pad = AudioSegment.silent(duration=max(0, int(pause_ms)))
-        for p in tmp_files:
-            seg = AudioSegment.from_file(str(p))
-            final += seg
-            if pad.duration_seconds > 0:
-                final += pad
-
-        out_path = OUT_DIR / f"{uuid.uuid4().hex}.wav"
-        final = final.set_frame_rate(24000).set_channels(1)
-        final.export(str(out_path), format="wav")
-
-        
-        PROGRESS[job_id]["url"] = out_path.name
-
-        for p in tmp_files:
-            try: p.unlink(missing_ok=True)
-            except: pass
+        try:
+            stage = Stage(f"t2v-write-{job_id[:8]}", write)
+            try:
+                for item in synth_blocks(job_id, blocks, lang, voice_path, start=done,
+                                         reuse=reused if reuse_map else None):
+                    check_cancel(p)
+                    stage.put(item)
+                    p["write_queue"] = stage.depth()
+            except BaseException:
+                stage.close(reraise=False)
+                raise
+            stage.close()
+            p["write_queue"] = 0
+
+            with timed(p, "finalize"):
+                writer.close()
+            p["chapters"] = writer.chapters or None
+            writer = None
+            p["url"] = out_path.name
+            p["status"] = "done"
+            JOBS_TOTAL.inc(kind="synth", status="done")
+            if ck:
+                ck.finish(out_path.name, chapters=p["chapters"], spans=spans, audio=audio_tag(),
+                          token_limit=TOKEN_LIMIT)
+        except JobCancelled:
+            # до finished: /events увидит уже отмену
+            p["status"] = "interrupted" if p.get("cancel") == "abandoned" else "cancelled"
+            raise
+        finally:
+            # открытые /stream держат свою ссылку на BlockStream; новым — редирект на файл
+            with _JOB_COND:
+                p["finished"] = True
+                p["finished_at"] = time.time()
+                idle = not streaming or not p["stream"].readers
+                p["stream"] = BlockStream() if streaming else None
+            notify_jobs()
+            if ck and idle and p["status"] == "done":
+                ck.purge_blocks()
+            for f in spilled:
+                try: f.unlink(missing_ok=True)
+                except: pass
+
+    except JobCancelled:
+        if writer is not None:
+            writer.abort()
+        finish_cancelled(job_id, p)
+    except Exception as e:
+        if writer is not None:
+            writer.abort()
+        p["error"] = f"{e}"
+        p["status"] = "error"
+        JOBS_TOTAL.inc(kind="synth", status="error")
+        ERRORS_TOTAL.inc(where="synth")
+        p["finished"] = True
+        p["finished_at"] = time.time()
+        notify_jobs()
+        if ck:
+            try: ck.set_state(status="error", error=f"{e}")
+            except OSError: pass
+
+# ---- пакетный синтез ----
+def do_batch(job_id: str, items: List[Dict], pause_ms: int, make_zip: bool):
+    """
+    Много коротких фраз одной задачей. Элементы группируются по (эталон, язык):
+    латенты считаются один раз на группу, а блоки группы идут в synth_blocks одним потоком
+    (XTTS не умеет батч с паддингом, зато в procs они расходятся по процессам параллельно).
+    Каждый элемент пишется в свой WAV, как только готов его последний блок.
+    """
+    p = PROGRESS[job_id]
+    try:
+        t0 = time.time()
+        prepared = []
+        for k, it in enumerate(items):
+            with timed(p, "normalize"):
+                txt = normalize_text(it["text"], hard=True)
+            with timed(p, "split"):
+                blocks = split_into_blocks(txt, max_len=BATCH_BLOCK_LEN, lang=it["lang"])
+            prepared.append((k, it["lang"], it["voice"], blocks))
+        groups: "OrderedDict[Tuple[Path, str], List]" = OrderedDict()
+        for item in prepared:
+            groups.setdefault((item[2], item[1]), []).append(item)
+        p.update(
+            total_blocks=sum(len(x[3]) for x in prepared),
+            total_chars=sum(len(b) for x in prepared for b in x[3]),
+            job_started=t0, status="running",
+        )
 
+        out_dir = OUT_DIR / f"batch_{job_id}"
+        out_dir.mkdir(parents=True, exist_ok=True)
+        files: List[Optional[str]] = [None] * len(items)
+        audio_sec = 0.0
+        last_t = time.time()
+        for (voice, lang), its in groups.items():
+            flat = [b for it in its for b in it[3]]
+            owner = [n for n, it in enumerate(its) for _ in it[3]]
+            left = [len(it[3]) for it in its]
+            parts: Dict[int, List[np.ndarray]] = {}
+            for i, b, a, dt in synth_blocks(job_id, flat, lang, voice):
+                n = owner[i - 1]
+                parts.setdefault(n, []).append(a)
+                left[n] -= 1
+                if not left[n]:
+                    k = its[n][0]
+                    with timed(p, "encode"):
+                        final = assemble(parts.pop(n), pause_ms)
+                        fname = f"{k + 1:05d}.wav"
+                        sf.write(str(out_dir / fname), final, OUT_SR, subtype="PCM_16")
+                    files[k] = f"{out_dir.name}/{fname}"
+                    audio_sec += final.size / OUT_SR
+                last_t = block_done(p, b, dt, last_t, a.size)
+
+        if make_zip:
+            zpath = OUT_DIR / f"batch_{job_id}.zip"
+            with zipfile.ZipFile(zpath, "w", compression=zipfile.ZIP_STORED) as z:
+                for f in files:
+                    if f:
+                        z.write(OUT_DIR / f, arcname=Path(f).name)
+            p["url"] = zpath.name
+
+        wall = max(0.001, time.time() - t0)
+        p["items"] = files
+        p["batch"] = dict(
+            items=len(items), groups=len(groups), wall_sec=wall, audio_sec=audio_sec,
+            chars_per_sec=p["total_chars"] / wall,
+            rtf=wall / audio_sec if audio_sec else None,
+        )
+        p["status"] = "done"
+        JOBS_TOTAL.inc(kind="batch", status="done")
+    except JobCancelled:
+        shutil.rmtree(OUT_DIR / f"batch_{job_id}", ignore_errors=True)
+        finish_cancelled(job_id, p)
     except Exception as e:
-        PROGRESS[job_id]["error"] = f"{e}"
+        p["error"] = f"{e}"
+        p["status"] = "error"
+        JOBS_TOTAL.inc(kind="batch", status="error")
+        ERRORS_TOTAL.inc(where="batch")
+    finally:
+        p["finished"] = True
+        p["finished_at"] = time.time()
+        notify_jobs()
+
+def parse_batch(raw: str) -> List[Dict]:
+    """
+    JSON-массив, {"items": [...]} или JSONL (по объекту на строку).
+    """
+    raw = raw.strip()
+    if not raw:
+        return []
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        data = [json.loads(l) for l in raw.splitlines() if l.strip()]
+    if isinstance(data, dict):
+        data = data.get("items", [data])
+    if not isinstance(data, list) or not all(isinstance(x, dict) for x in data):
+        raise ValueError("ожидается массив объектов {text, lang, voice}")
+    return data
+
+def evict_jobs():
+    """
+    Чистка PROGRESS: завершённые старше JOB_TTL_SEC, затем самые старые сверх JOB_MAX.
+    Идущие задачи не трогаем; задачи с чекпоинтом восстановятся по запросу (find_job).
+    """
+    now = time.time()
+    done = sorted((p.get("finished_at") or 0.0, jid) for jid, p in list(PROGRESS.items()) if p.get("finished"))
+    drop = {jid for t, jid in done if now - t > JOB_TTL_SEC}
+    extra = len(PROGRESS) - len(drop) - JOB_MAX
+    for _, jid in done:
+        if extra <= 0:
+            break
+        if jid not in drop:
+            drop.add(jid)
+            extra -= 1
+    for jid in drop:
+        p = PROGRESS.pop(jid, None)
+        if p and p.get("status") == "done" and JobCheckpoint.exists(jid):
+            JobCheckpoint(jid).purge_blocks()
+
+def check_cancel(p: Dict):
+    if p.get("cancel"):
+        raise JobCancelled(p["cancel"])
+
+def cancel_job(job_id: str, reason: str = "cancelled") -> bool:
+    """
+    Отмена: из очереди задача снимается сразу, идущая останавливается перед следующим блоком
+    (в thread-движке — и посреди блока), недописанные файлы удаляются. Чекпоинт удаляется
+    при явной отмене; брошенная задача (reason="abandoned") остаётся прерванной и её можно продолжить.
+    False — задачи нет или она уже завершилась.
+    """
+    p = PROGRESS.get(job_id)
+    if not p or p.get("finished") or p.get("cancel"):
+        return False
+    p["cancel"] = reason
+    if SCHED.drop(job_id):
+        finish_cancelled(job_id, p)
+    SCHED.wake()
+    notify_jobs()
+    return True
+
+def finish_cancelled(job_id: str, p: Dict):
+    keep = p["cancel"] == "abandoned" and JobCheckpoint.exists(job_id)
+    p.update(status="interrupted" if keep else "cancelled", finished=True, finished_at=time.time(),
+             stream=BlockStream())
+    JOBS_TOTAL.inc(kind="batch" if "batch_items" in p else "synth", status="cancelled")
+    if keep:
+        # вкладку могли просто перезагрузить: готовые блоки ждут /jobs/<id>/resume (или purge_jobs)
+        JobCheckpoint(job_id).set_state(status="interrupted")
+    else:
+        shutil.rmtree(JOBS_DIR / job_id, ignore_errors=True)
+    print(f"[jobs] job {job_id} cancelled ({p['cancel']})")
+    notify_jobs()
+
+def abandon_jobs():
+    """
+    Задачи из UI (heartbeat), которые никто не опрашивал и не слушал ABANDON_SEC, отменяются.
+    """
+    if ABANDON_SEC <= 0:
+        return
+    now = time.time()
+    for jid, p in list(PROGRESS.items()):
+        if p.get("heartbeat") and not p.get("finished") and now - (p.get("seen") or now) > ABANDON_SEC:
+            cancel_job(jid, "abandoned")
+
+def janitor(period: float = 60.0):
+    # брошенные задачи замечаем не позже чем через четверть ABANDON_SEC
+    if ABANDON_SEC > 0:
+        period = min(period, max(1.0, ABANDON_SEC / 4))
+    while True:
+        time.sleep(period)
+        try:
+            evict_jobs()
+            purge_jobs()
+            abandon_jobs()
+        except Exception as e:
+            print(f"[jobs] eviction failed: {e}")
+
+def start_job(job_id: str, client: str, text: str, lang: str, voice_wav: Path, block_len: int, pause_ms: int,
+              fmt: str = "wav", bitrate: int = 0, profile: str = "", stages: Optional[Dict] = None,
+              longform: str = "", parent: str = "", heartbeat: bool = False):
+    """
+    Ставит задачу в очередь планировщика (QueueFull пробрасывается наверх).
+    heartbeat — задачу ждёт клиент: без опросов ABANDON_SEC она отменяется (abandon_jobs).
+    """
+    evict_jobs()
+    purge_jobs()
+    PROGRESS[job_id] = new_progress()
+    PROGRESS[job_id].update(pause_ms=pause_ms, queued_chars=len(text), stages=dict(stages or {}),
+                            heartbeat=heartbeat, seen=time.time())
+    try:
+        SCHED.submit(client, job_id, do_synth, job_id, text, lang, voice_wav, block_len, pause_ms, fmt, bitrate,
+                     profile, longform, None, parent)
+    except QueueFull:
+        PROGRESS.pop(job_id, None)
+        raise
+
+def resume_job(job_id: str, client: str = "resume", heartbeat: bool = False):
+    ck = JobCheckpoint(job_id)
+    prm = ck.params() or {}
+    start_job(job_id, prm.get("client") or client, prm.get("text", ""), prm["lang"],
+              Path(prm["voice"]), int(prm["block_len"]), int(prm["pause_ms"]),
+              prm.get("fmt", "wav"), int(prm.get("bitrate") or 0), longform=prm.get("longform", ""),
+              parent=prm.get("parent", ""), heartbeat=heartbeat)
+
+def restore_jobs():
+    """
+    При старте: незавершённые задачи из JOBS_DIR — в PROGRESS (или сразу в очередь при T2V_AUTORESUME=1).
+    Недописанные *.part прошлого процесса удаляются: продолжение задачи пишет файл заново.
+    """
+    for f in OUT_DIR.rglob("*.part"):
+        try: f.unlink()
+        except OSError: pass
+    if not CHECKPOINT_JOBS:
+        return
+    purge_jobs()
+    for d in sorted(JOBS_DIR.iterdir()):
+        if not JobCheckpoint.exists(d.name):
+            continue
+        st = JobCheckpoint(d.name).state().get("status")
+        if st == "done":
+            JobCheckpoint(d.name).purge_blocks()
+        if st not in ("queued", "running"):
+            continue
+        p = restore_job(d.name)
+        print(f"[jobs] interrupted job {d.name}: {p['done_blocks']}/{p['total_blocks']} blocks")
+        if AUTORESUME:
+            try:
+                resume_job(d.name)
+            except (QueueFull, KeyError, OSError) as e:
+                print(f"[jobs] resume {d.name} skipped: {e}")
 
 @app.route("/")
 def home():
@@ -459,8 +2701,19 @@ def synth_route():
         block_len = int(request.form.get("block", "360"))
         pause_ms  = int(request.form.get("pause", "120"))
         norm      = request.form.get("norm", "1") == "1"
+        fmt       = request.form.get("fmt", "wav")
+        bitrate   = int(request.form.get("bitrate") or 0)
+        profile   = PROFILERS[request.values.get("profile") or "0"]
+        longform  = request.form.get("longform", "")
+        parent    = request.form.get("parent", "")
     except:
         return jsonify({"error":"Неверные параметры"}), 400
+    if fmt not in OUT_FORMATS or not 0 <= bitrate <= 512:
+        return jsonify({"error":"Неверный формат"}), 400
+    if longform not in ("", "markers", "files"):
+        return jsonify({"error":"Неверный режим длинной формы"}), 400
+    if parent and not _JOB_ID.fullmatch(parent):
+        return jsonify({"error":"Неверная прошлая версия задачи"}), 400
 
     if not text:
         return jsonify({"error":"Пустой текст"}), 400
@@ -470,49 +2723,295 @@ def synth_route():
     voice_path: Optional[Path] = None
     up = request.files.get("voice_upload")
     if up and up.filename:
-        dest = VOICE_DIR / safe_name(up.filename)
-        up.save(str(dest))
-        voice_path = dest
+        voice_path = VOICES.add_upload(up)
     else:
         choice = request.form.get("voice_choice", "")
         if choice:
-            cand = VOICE_DIR / safe_name(choice)
-            if cand.exists():
-                voice_path = cand
+            voice_path = VOICES.find(choice)
 
     if not voice_path:
         return jsonify({"error":"Загрузите или выберите эталонный голос"}), 400
-
-    if norm:
-        text = normalize_text(text, hard=True)
+    if MODEL_STATE["phase"] == "error":
+        return jsonify({"error": f"Модель не загрузилась: {MODEL_STATE['error']}"}), 503
+
+    req: Dict = {}      # этапы до постановки в очередь — переедут в прогресс задачи
+    if norm and not longform:
+        # в длинной форме нормализует do_synth по главам: заголовки ищутся по переводам строк
+        with timed(req, "normalize"):
+            text = normalize_text(text, hard=True)
     try:
-        voice_wav = ensure_wav_24k_mono(voice_path)
+        with timed(req, "voice_convert"):
+            voice_wav = ensure_wav_24k_mono(voice_path)
     except Exception as e:
+        ERRORS_TOTAL.inc(where="voice")
         return jsonify({"error": f"Ошибка конвертации эталона: {e}"}), 500
 
     job_id = uuid.uuid4().hex
-    PROGRESS[job_id] = dict(
-        done_blocks=0, total_blocks=0,
-        chars_done=0, total_chars=0,
-        cur_block_len=0, cur_block_started=None,
-        ema_rate=18.0, url=None, error=None,
-        job_started=time.time()
-    )
+    client = client_key()
+    if CHECKPOINT_JOBS:
+        JobCheckpoint(job_id).create(dict(
+            text=text, lang=lang, voice=str(voice_wav),
+            block_len=block_len, pause_ms=pause_ms, client=client,
+            fmt=fmt, bitrate=bitrate, longform=longform, parent=parent,
+        ))
+    try:
+        start_job(job_id, client, text, lang, voice_wav, block_len, pause_ms, fmt, bitrate, profile,
+                  req.get("stages"), longform=longform, parent=parent,
+                  heartbeat=request.form.get("heartbeat") == "1")
+    except QueueFull as e:
+        shutil.rmtree(JOBS_DIR / job_id, ignore_errors=True)
+        return queue_full(e)
+
+    return jsonify({"job_id": job_id, "stream": url_for("stream", job_id=job_id)})
+
+def queue_full(e: QueueFull):
+    ERRORS_TOTAL.inc(where="queue_full")
+    resp = jsonify({"error": "Сервер перегружен, повторите позже", "retry_after": e.retry_after})
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp, 429
+
+@app.route("/batch", methods=["POST"])
+def batch_route():
+    """
+    Пакет коротких фраз: тело — JSON-массив/JSONL из {text, lang, voice} (или файл в поле items).
+    voice — имя файла эталона из библиотеки; lang/voice по умолчанию берутся из ?lang= и ?voice=.
+    """
+    up = request.files.get("items")
+    try:
+        raw = up.read().decode("utf-8") if up else request.get_data(as_text=True)
+        data = parse_batch(raw)
+        pause_ms = int(request.args.get("pause", "120"))
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({"error": f"Неверный пакет: {e}"}), 400
+    if not data:
+        return jsonify({"error":"Пустой пакет"}), 400
+    if len(data) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Не больше {BATCH_MAX_ITEMS} элементов"}), 400
+    if MODEL_STATE["phase"] == "error":
+        return jsonify({"error": f"Модель не загрузилась: {MODEL_STATE['error']}"}), 503
+
+    voices: Dict[str, Path] = {}
+    items: List[Dict] = []
+    for n, it in enumerate(data):
+        text = str(it.get("text") or "").strip()
+        lang = it.get("lang") or request.args.get("lang", DEFAULT_LANG)
+        vname = safe_name(str(it.get("voice") or request.args.get("voice", "")))
+        if not text:
+            return jsonify({"error": f"#{n}: пустой текст"}), 400
+        if lang not in LANGS:
+            return jsonify({"error": f"#{n}: неверный язык"}), 400
+        if vname not in voices:
+            src = VOICES.find(vname) if vname else None
+            if src is None:
+                return jsonify({"error": f"#{n}: нет эталона {vname!r}"}), 400
+            try:
+                voices[vname] = ensure_wav_24k_mono(src)
+            except Exception as e:
+                return jsonify({"error": f"Ошибка конвертации эталона {vname}: {e}"}), 500
+        items.append(dict(text=text, lang=lang, voice=voices[vname]))
+
+    job_id = uuid.uuid4().hex
+    make_zip = request.args.get("zip", "1") == "1"
+    evict_jobs()
+    PROGRESS[job_id] = new_progress()
+    PROGRESS[job_id].update(queued_chars=sum(len(x["text"]) for x in items), batch_items=len(items))
+    try:
+        SCHED.submit(client_key(), job_id, do_batch, job_id, items, pause_ms, make_zip)
+    except QueueFull as e:
+        PROGRESS.pop(job_id, None)
+        return queue_full(e)
+    return jsonify({
+        "job_id": job_id, "items": len(items),
+        "progress": url_for("progress", job_id=job_id),
+        "result": url_for("batch_result", job_id=job_id),
+    })
+
+@app.route("/batch/<job_id>")
+def batch_result(job_id):
+    """
+    Итог пакета: ссылки на WAV каждого элемента (по порядку), zip и пропускная способность.
+    """
+    p = PROGRESS.get(job_id)
+    if not p or "batch_items" not in p:
+        return jsonify({"error":"no such batch"}), 404
+    if p.get("error"):
+        return jsonify({"error": p["error"]}), 500
+    items = p.get("items") or []
+    return jsonify({
+        "status": p.get("status"),
+        "done": int(p.get("done_blocks") or 0),
+        "total": int(p.get("total_blocks") or 0),
+        "items": [url_for("audio", fname=f) if f else None for f in items],
+        "zip": url_for("audio", fname=p["url"]) if p.get("url") else None,
+        "stats": p.get("batch"),
+    })
 
-    th = threading.Thread(target=do_synth, args=(job_id, text, lang, voice_wav, block_len, pause_ms), daemon=True)
-    th.start()
+@app.route("/voices")
+def voices_route():
+    """
+    Библиотека эталонов из индекса, последние использованные — первыми.
+    """
+    n = int(request.args.get("n", RECENT_VOICES))
+    return jsonify([{k: e.get(k) for k in ("name", "hash", "duration", "size", "used")}
+                    for e in VOICES.recent(n)])
 
-    return jsonify({"job_id": job_id})
+@app.route("/healthz")
+def healthz():
+    """
+    Процесс жив (отвечает всегда, пока работает HTTP).
+    """
+    return jsonify({"status": "ok", "phase": MODEL_STATE["phase"]})
 
-@app.route("/progress/<job_id>")
-def progress(job_id):
+@app.route("/readyz")
+def readyz():
+    """
+    Готовность к синтезу: 200 после загрузки и прогрева модели, иначе 503 с фазой и таймингами.
+    """
+    st = dict(MODEL_STATE)
+    if st["started"] and st["phase"] in ("loading", "warmup"):
+        st["elapsed_sec"] = time.time() - st["started"]
+    st["engine"] = ENGINE
+    return jsonify(st), 200 if st["phase"] == "ready" else 503
+
+@app.route("/jobs/<job_id>")
+def job_info(job_id):
+    """
+    Состояние задачи по чекпоинту: параметры, статус, сколько блоков готово.
+    """
+    if not JobCheckpoint.exists(job_id):
+        p = PROGRESS.get(job_id)
+        if not p:
+            return jsonify({"error":"no such job"}), 404
+        return jsonify({"job_id": job_id, "status": p.get("status"), "checkpoint": False})
+    ck = JobCheckpoint(job_id)
+    prm, st = ck.params() or {}, ck.state()
+    p = PROGRESS.get(job_id) or {}
+    blocks = ck.blocks()
+    return jsonify({
+        "job_id": job_id,
+        "status": p.get("status") or st.get("status"),
+        "done": int(p.get("done_blocks") or ck.done_count()),
+        "total": len(blocks) if blocks is not None else None,
+        "params": {k: v for k, v in prm.items() if k not in ("text", "client")},
+        "text_chars": len(prm.get("text", "")),
+        "url": url_for("audio", fname=st["url"]) if st.get("url") else None,
+        "error": st.get("error"),
+        "checkpoint": True,
+    })
+
+@app.route("/jobs/<job_id>/profile")
+def job_profile(job_id):
+    """
+    Дамп профилировщика задачи (запуск с profile=1|torch); ?format=text — топ функций cProfile.
+    """
+    if not _JOB_ID.fullmatch(job_id):
+        return jsonify({"error":"no such job"}), 404
+    for f in (PROFILE_DIR / f"{job_id}.prof", PROFILE_DIR / f"{job_id}.json"):
+        if f.exists():
+            break
+    else:
+        return jsonify({"error":"no profile for this job"}), 404
+    if request.args.get("format") == "text" and f.suffix == ".prof":
+        import pstats
+        buf = io.StringIO()
+        pstats.Stats(str(f), stream=buf).sort_stats("cumulative").print_stats(int(request.args.get("top", "40")))
+        return Response(buf.getvalue(), mimetype="text/plain; charset=utf-8")
+    return send_from_directory(PROFILE_DIR, f.name, as_attachment=True)
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def job_cancel(job_id):
+    """
+    Отменить задачу в очереди или в работе (UI зовёт при новом запуске).
+    reason=abandoned (закрытие вкладки) — работа останавливается, но чекпоинт остаётся для resume.
+    """
     p = PROGRESS.get(job_id)
     if not p:
         return jsonify({"error":"no such job"}), 404
+    reason = "abandoned" if request.values.get("reason") == "abandoned" else "cancelled"
+    if not cancel_job(job_id, reason) and not p.get("cancel"):
+        return jsonify({"error":"job is finished", "status": p.get("status")}), 409
+    return jsonify({"job_id": job_id, "status": "cancelled" if p.get("finished") else "cancelling"})
 
-    if p.get("error"):
-        return jsonify({"error": p["error"]}), 500
+@app.route("/jobs/<job_id>/resume", methods=["POST"])
+def job_resume(job_id):
+    """
+    Продолжить прерванную задачу с последнего готового блока.
+    """
+    if not JobCheckpoint.exists(job_id):
+        return jsonify({"error":"no such job"}), 404
+    p = PROGRESS.get(job_id)
+    if p and not p.get("finished"):
+        return jsonify({"error":"job is running", "status": p.get("status")}), 409
+    st = JobCheckpoint(job_id).state()
+    if st.get("status") == "done" and st.get("url"):
+        return jsonify({"job_id": job_id, "url": url_for("audio", fname=st["url"])})
+    try:
+        resume_job(job_id, client_key(), heartbeat=request.values.get("heartbeat") == "1")
+    except QueueFull as e:
+        return queue_full(e)
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"broken checkpoint: {e}"}), 500
+    return jsonify({"job_id": job_id, "stream": url_for("stream", job_id=job_id)})
+
+def latent_info(p: Dict) -> Dict:
+    """
+    Откуда взяты латенты эталона и сколько времени это сэкономило за задачу
+    (без кэша они считались бы на каждом блоке).
+    """
+    src = p.get("latent_src")
+    done = int(p.get("done_blocks") or 0)
+    calls_saved = done - (1 if src == "miss" else 0)
+    return {
+        "source": src,
+        "sec": float(p.get("latent_sec") or 0.0),
+        "saved_sec": float(max(0, calls_saved) * latent_cost_sec()),
+        "hits": LATENT_STATS["mem_hits"] + LATENT_STATS["disk_hits"],
+        "misses": LATENT_STATS["misses"],
+    }
+
+def block_cache_info(p: Dict) -> Dict:
+    hits, misses = int(p.get("cache_hits") or 0), int(p.get("cache_misses") or 0)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+        "bytes_saved": int(p.get("cache_bytes_saved") or 0),
+        "total": dict(BLOCK_CACHE.stats),
+    }
+
+def timing_info(job_id: str, p: Dict) -> Dict:
+    """
+    Секунды по этапам задачи и real-time factor инференса (сек. вычислений / сек. аудио).
+    """
+    st = dict(p.get("stages") or {})
+    infer = float(st.get("infer") or 0.0)
+    audio = float(p.get("infer_audio_sec") or 0.0)
+    started = p.get("job_started")
+    wall = max(0.001, float(p.get("finished_at") or time.time()) - float(started)) if started else None
+    busy = {
+        "prep": st.get("normalize", 0.0) + st.get("split", 0.0),
+        "infer": infer,
+        "post": st.get("post", 0.0),
+        "write": st.get("checkpoint", 0.0) + st.get("encode", 0.0) + st.get("finalize", 0.0),
+    }
+    return {
+        "stages": st,
+        # доля времени задачи, когда стадия занята (в procs инференс параллельный — может быть > 1)
+        "utilization": {k: v / wall for k, v in busy.items()} if wall else None,
+        "queues": {"post": int(p.get("post_queue") or 0), "write": int(p.get("write_queue") or 0)},
+        "audio_sec": float(p.get("audio_sec") or 0.0),
+        "rtf": infer / audio if audio else None,
+        "profile": url_for("job_profile", job_id=job_id) if p.get("profile") else None,
+    }
 
+def progress_payload(job_id: str, p: Dict) -> Dict:
+    """
+    Снимок прогресса с ETA — общий для /progress и /events.
+    """
     started = float(p.get("job_started") or time.time())
     elapsed = max(0.0, time.time() - started)
 
@@ -535,19 +3034,303 @@ def progress(job_id):
     if p.get("url"):
         url = url_for("audio", fname=p["url"])
 
-    return jsonify({
+    return {
         "done": int(p.get("done_blocks", 0)),
         "total": int(p.get("total_blocks", 0)),
         "progress": float(prog),
         "elapsed_sec": float(elapsed),
         "eta_sec": float(eta),
-        "url": url
-    })
+        "url": url,
+        "status": p.get("status"),
+        "latents": latent_info(p),
+        "queue": SCHED.queue_info(job_id),
+        "cache": block_cache_info(p),
+        "batch": p.get("batch"),
+        "revision": p.get("revision"),
+        "timing": timing_info(job_id, p),
+        "chapters": [dict(title=c.get("title"), start_sec=float(c.get("start_sec") or 0.0),
+                          url=url_for("audio", fname=c["file"]) if c.get("file") else None)
+                     for c in p.get("chapters") or []] or None,
+    }
+
+@app.route("/progress/<job_id>")
+def progress(job_id):
+    p = find_job(job_id)
+    if not p:
+        return jsonify({"error":"no such job"}), 404
+    p["seen"] = time.time()
+
+    if p.get("error"):
+        return jsonify({"error": p["error"]}), 500
+
+    return jsonify(progress_payload(job_id, p))
+
+@app.route("/events/<job_id>")
+def events(job_id):
+    """
+    Server-Sent Events: снимок прогресса уходит только при изменении состояния
+    (готов блок, сдвинулась очередь, финиш); между ними — редкий keep-alive.
+    """
+    if not find_job(job_id):
+        return jsonify({"error":"no such job"}), 404
+
+    def sse(event: str, data: Dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def gen():
+        ver, last, pinged = -1, None, time.time()
+        while True:
+            p = find_job(job_id)     # resume заменяет запись
+            if not p:
+                yield sse("failed", {"error": "no such job"})
+                return
+            p["seen"] = time.time()  # клиент отвалился — генератор остановится на очередном yield
+            if p.get("error"):
+                yield sse("failed", {"error": p["error"]})
+                return
+            q = SCHED.queue_info(job_id)
+            state = (p.get("done_blocks"), p.get("status"), p.get("url"), q and q["pos"])
+            if state != last:
+                last = state
+                pinged = time.time()
+                yield sse("progress", progress_payload(job_id, p))
+                if p.get("finished"):
+                    return
+            elif time.time() - pinged > 15:
+                pinged = time.time()
+                yield ": ping\n\n"
+            ver = wait_jobs(ver, timeout=5.0)
+
+    return Response(stream_with_context(gen()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/stream/<job_id>")
+def stream(job_id):
+    """
+    WAV по мере синтеза: первый блок звучит сразу, как только готов.
+    """
+    p = find_job(job_id)
+    if not p:
+        return jsonify({"error":"no such job"}), 404
+    if p.get("finished"):
+        if p.get("url"):
+            return redirect(url_for("audio", fname=p["url"]))
+        return jsonify({"error": p.get("error") or "job finished"}), 410
+
+    items: BlockStream = p["stream"]
+    pad = np.zeros(int(OUT_SR * max(0, int(p.get("pause_ms") or 0)) / 1000), dtype=np.float32)
+
+    def gen():
+        rid = items.open()
+        try:
+            yield wav_stream_header()
+            while True:
+                with _JOB_COND:
+                    a = items.next(rid)
+                    while a is None and not p.get("finished"):
+                        p["seen"] = time.time()
+                        _JOB_COND.wait(timeout=1.0)
+                        a = items.next(rid)
+                if a is None:
+                    return
+                if isinstance(a, Path):
+                    try:
+                        a = np.load(str(a))
+                    except OSError:
+                        return
+                yield pcm16(a)
+                if pad.size:
+                    yield pcm16(pad)
+        finally:
+            # последний слушатель завершённой задачи — копии блоков в чекпоинте больше не нужны
+            with _JOB_COND:
+                idle = items.close(rid) == 0 and p.get("finished") and p.get("status") == "done"
+            if idle and JobCheckpoint.exists(job_id):
+                JobCheckpoint(job_id).purge_blocks()
+
+    return Response(stream_with_context(gen()), mimetype="audio/wav",
+                    headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"})
 
 @app.route("/audio/<path:fname>")
 def audio(fname):
-    return send_from_directory(OUT_DIR, fname, as_attachment=False)
+    """
+    Готовые файлы неизменяемы (имя — uuid): Range/206, ETag и Last-Modified отдаёт werkzeug
+    (conditional=True), так что плеер перематывает, не качая файл целиком.
+    ?download=1 — как вложение.
+    """
+    resp = send_from_directory(
+        OUT_DIR, fname,
+        as_attachment=request.args.get("download") == "1",
+        mimetype=MIME_BY_EXT.get(Path(fname).suffix.lstrip(".").lower()),
+        conditional=True, etag=True, max_age=86400,
+    )
+    resp.headers["Accept-Ranges"] = "bytes"
+    return resp
+
+
+# ---- командная строка (без Flask) ----
+CLI_STAMPS = ".t2v-done.json"       # в папке вывода: файл -> отпечаток входа и параметров
+CLI_TEXT_EXT = (".txt", ".md")
 
+def cli_items(inputs: List[Path], out_dir: Path, defaults: Dict) -> List[Dict]:
+    """
+    Входы -> задания {text, src, out, lang, voice, fmt, bitrate, block_len, pause_ms, longform}:
+    файл с текстом, папка (*.txt, *.md рекурсивно, структура повторяется в out_dir)
+    или манифест .jsonl — по объекту на строку: {"text"|"file", "out"?, "lang"?, "voice"?, "fmt"?, ...}.
+    """
+    items: List[Dict] = []
+
+    def add(text: str, src: Optional[Path], rel: Path, **kw):
+        it = dict(defaults, **{k: v for k, v in kw.items() if v is not None})
+        ext = OUT_FORMATS[it["fmt"]][0]
+        out = rel if rel.suffix.lstrip(".") == ext else rel.with_suffix(f".{ext}")
+        items.append(dict(it, text=text, src=src, out=out_dir / out))
+
+    for inp in inputs:
+        if inp.is_dir():
+            for f in sorted(x for x in inp.rglob("*") if x.suffix.lower() in CLI_TEXT_EXT and x.is_file()):
+                add(f.read_text(encoding="utf-8-sig"), f, f.relative_to(inp))
+        elif inp.suffix.lower() == ".jsonl":
+            for n, line in enumerate(inp.read_text(encoding="utf-8-sig").splitlines(), 1):
+                if not line.strip():
+                    continue
+                it = json.loads(line)
+                src = (inp.parent / it["file"]) if it.get("file") else None
+                text = src.read_text(encoding="utf-8-sig") if src else str(it.get("text") or "")
+                rel = Path(it.get("out") or (src.stem if src else f"{inp.stem}_{n:05d}"))
+                add(text, src, rel, lang=it.get("lang"), fmt=it.get("fmt"), longform=it.get("longform"),
+                    voice=(inp.parent / it["voice"]) if it.get("voice") else None)
+        else:
+            add(inp.read_text(encoding="utf-8-sig"), inp, Path(inp.stem))
+    return items
+
+def cli_stamp(it: Dict) -> str:
+    # отпечаток всего, от чего зависит результат; совпал и файл на месте — пропускаем
+    raw = json.dumps([
+        it["text"], file_digest(it["voice"]), it["lang"], it["fmt"], it["bitrate"], it["block_len"],
+        it["pause_ms"], it["longform"], BLOCK_CACHE.version, BLOCK_CACHE.params, TOKEN_LIMIT,
+    ], ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def cli(argv: List[str]) -> int:
+    """
+    python synth.py synth INPUT... --voice ref.wav --out DIR — синтез без веб-сервера.
+    Модель (тот же кэш MODEL_DIR, что готовит rt_bootstrap) грузится один раз, задания идут
+    в --jobs потоков через тот же конвейер do_synth; уже готовые файлы пропускаются.
+    """
+    import argparse
+    from concurrent.futures import as_completed
+
+    ap = argparse.ArgumentParser(prog="synth.py synth", description="Text2Voice: офлайн-синтез из файлов")
+    ap.add_argument("inputs", nargs="+", type=Path, help="файл .txt, папка или манифест .jsonl")
+    ap.add_argument("--voice", type=Path, help="эталонный голос (wav/mp3) по умолчанию")
+    ap.add_argument("--out", type=Path, default=OUT_DIR, help="папка для результатов")
+    ap.add_argument("--lang", default=DEFAULT_LANG, choices=sorted(LANGS))
+    ap.add_argument("--fmt", default="wav", choices=sorted(OUT_FORMATS))
+    ap.add_argument("--bitrate", type=int, default=0, help="кбит/с для opus/mp3 (0 — по умолчанию)")
+    ap.add_argument("--block", type=int, default=360, dest="block_len")
+    ap.add_argument("--pause", type=int, default=120, dest="pause_ms")
+    ap.add_argument("--longform", default="", choices=["", "markers", "files"])
+    ap.add_argument("--jobs", type=int, default=max(1, INFER_WORKERS), help="сколько файлов синтезировать одновременно")
+    ap.add_argument("--force", action="store_true", help="не пропускать готовые")
+    ap.add_argument("--summary", type=Path, help="сохранить итог в JSON")
+    args = ap.parse_args(argv)
+
+    # офлайн: только локальный кэш модели
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    global CHECKPOINT_JOBS
+    CHECKPOINT_JOBS = False         # повтор — на уровне файлов (пропуск готовых)
+
+    defaults = dict(lang=args.lang, voice=args.voice, fmt=args.fmt, bitrate=args.bitrate,
+                    block_len=args.block_len, pause_ms=args.pause_ms, longform=args.longform)
+    try:
+        items = cli_items(args.inputs, args.out, defaults)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[cli] bad input: {e}")
+        return 2
+    for it in items:
+        if it["voice"] is None:
+            print(f"[cli] {it['out'].name}: no voice (--voice or \"voice\" in the manifest)")
+            return 2
+        if it["lang"] not in LANGS or it["fmt"] not in OUT_FORMATS:
+            print(f"[cli] {it['out'].name}: bad lang/fmt")
+            return 2
+        it["voice"] = ensure_wav_24k_mono(it["voice"])
+
+    stamps_lock = threading.Lock()
+    stamps_path = args.out / CLI_STAMPS
+    args.out.mkdir(parents=True, exist_ok=True)
+    stamps: Dict[str, str] = _read_json(stamps_path) or {}
+    todo, skipped = [], 0
+    for it in items:
+        it["stamp"] = cli_stamp(it)
+        key = it["out"].relative_to(args.out).as_posix()
+        if not args.force and it["out"].exists() and stamps.get(key) == it["stamp"]:
+            skipped += 1
+        else:
+            todo.append(it)
+    print(f"[cli] {len(items)} inputs: {len(todo)} to synthesize, {skipped} up to date")
+    if not todo:
+        return 0
+
+    start_model_loader()
+    t_load = time.time()
+    wait_model()
+    print(f"[cli] model ready in {time.time() - t_load:.1f}s")
+
+    def run(it: Dict) -> Dict:
+        job_id = uuid.uuid4().hex
+        p = PROGRESS[job_id] = new_progress()
+        p["stream"] = None
+        it["out"].parent.mkdir(parents=True, exist_ok=True)
+        t0 = time.time()
+        do_synth(job_id, it["text"], it["lang"], it["voice"], it["block_len"], it["pause_ms"],
+                 it["fmt"], it["bitrate"], "", it["longform"], out=it["out"])
+        PROGRESS.pop(job_id, None)
+        if p.get("error"):
+            raise RuntimeError(p["error"])
+        with stamps_lock:
+            stamps[it["out"].relative_to(args.out).as_posix()] = it["stamp"]
+            _write_json(stamps_path, stamps)
+        return dict(chars=p["total_chars"], audio_sec=p["audio_sec"], wall=time.time() - t0)
+
+    t0 = time.time()
+    done, failed, chars, audio = 0, 0, 0, 0.0
+    with ThreadPoolExecutor(max(1, args.jobs), thread_name_prefix="t2v-cli") as ex:
+        futs = {ex.submit(run, it): it for it in todo}
+        for f in as_completed(futs):
+            it = futs[f]
+            try:
+                r = f.result()
+            except Exception as e:
+                failed += 1
+                print(f"[cli] FAIL {it['out']}: {e}")
+                continue
+            done += 1
+            chars += r["chars"]
+            audio += r["audio_sec"]
+            print(f"[cli] {done + failed}/{len(todo)} {it['out']} — {r['chars']} chars, "
+                  f"{r['audio_sec']:.0f}s audio in {r['wall']:.1f}s")
+    wall = max(0.001, time.time() - t0)
+    summary = dict(
+        inputs=len(items), synthesized=done, skipped=skipped, failed=failed, chars=chars,
+        audio_sec=audio, wall_sec=wall, chars_per_sec=chars / wall,
+        rtf=wall / audio if audio else None, jobs=args.jobs, engine=ENGINE,
+    )
+    rtf = f"{summary['rtf']:.2f}" if summary["rtf"] else "-"
+    print(f"[cli] done {done}, skipped {skipped}, failed {failed}: {chars} chars -> {audio / 60:.1f} min audio "
+          f"in {wall:.1f}s ({chars / wall:.1f} chars/s, RTF {rtf})")
+    if args.summary:
+        args.summary.write_text(json.dumps(summary, indent=2, ensure_ascii=False), encoding="utf-8")
+    return 1 if failed else 0
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    import sys
+    if sys.argv[1:2] == ["synth"]:
+        sys.exit(cli(sys.argv[2:]))
+    start_model_loader()
+    restore_jobs()
+    threading.Thread(target=janitor, name="t2v-janitor", daemon=True).start()
     app.run(host="127.0.0.1", port=5000, debug=False, use_reloader=False)
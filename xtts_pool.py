@@ -0,0 +1,233 @@
+# xtts_pool.py
+"""
+Пул процессов с репликами XTTS (T2V_ENGINE=procs).
+
+Каждый процесс грузит свою модель и явно ограничивает потоки torch, блоки уходят
+в свободный процесс, аудио возвращается через shared memory (без pickle массивов).
+Модуль не импортирует synth: дочерние процессы поднимаются через spawn.
+Здесь же режим "fast" для CPU (prepare_model): int8-квантование линейных слоёв и inference_mode.
+"""
+from __future__ import annotations
+
+import os
+import time
+import contextlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, Future
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+_MODEL = None
+_LATENTS: Dict[str, Tuple[object, object]] = {}
+_LATENT_ITEMS = 4
+_PREPARED: Optional[Dict] = None
+
+
+# ---- общие вызовы XTTS (их же использует synth.py в своём процессе) ----
+def xtts_latents(m, voice_wav: Path):
+    c = m.config
+    return m.get_conditioning_latents(
+        audio_path=[str(voice_wav)],
+        gpt_cond_len=c.gpt_cond_len,
+        gpt_cond_chunk_len=c.gpt_cond_chunk_len,
+        max_ref_length=c.max_ref_len,
+        sound_norm_refs=c.sound_norm_refs,
+    )
+
+def xtts_infer(m, text: str, lang: str, gpt, spk):
+    """
+    Один блок из готовых латентов (те же настройки, что у tts_to_file).
+    """
+    c = m.config
+    with _infer_ctx(m):
+        out = m.inference(
+            text, lang, gpt, spk,
+            temperature=c.temperature,
+            length_penalty=c.length_penalty,
+            repetition_penalty=c.repetition_penalty,
+            top_k=c.top_k,
+            top_p=c.top_p,
+            enable_text_splitting=True,
+        )
+    return out["wav"]
+
+def _infer_ctx(m):
+    if getattr(m, "_t2v_fast", False):
+        import torch
+        return torch.inference_mode()
+    return contextlib.nullcontext()
+
+def model_bytes(m) -> int:
+    """
+    Память весов и буферов torch-модели в байтах (включая упакованные int8-веса).
+    """
+    n = sum(t.numel() * t.element_size() for t in list(m.parameters()) + list(m.buffers()))
+    for mod in m.modules():
+        if hasattr(mod, "_weight_bias"):    # динамически квантованный Linear: веса не в parameters()
+            n += sum(t.numel() * t.element_size() for t in mod._weight_bias() if t is not None)
+    return n
+
+
+# ---- режим CPU: потоки и int8 ----
+CPU_MODES = ("fp32", "fast")
+
+def set_threads(threads: int, interop: int) -> Tuple[int, int]:
+    """
+    Явные intra-op/inter-op потоки torch (0 — не трогать). Inter-op задаётся только
+    до первой параллельной операции, повторная попытка молча игнорируется.
+    """
+    import torch
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interop > 0:
+        try:
+            torch.set_num_interop_threads(interop)
+        except RuntimeError:
+            pass
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+def _conv1d_to_linear(root) -> int:
+    # GPT-2 из transformers держит проекции в Conv1D (x @ W + b, W: in x out),
+    # quantize_dynamic их не видит — меняем на эквивалентный nn.Linear
+    import torch
+    n = 0
+    for mod in list(root.modules()):
+        for name, ch in list(mod.named_children()):
+            if type(ch).__name__ != "Conv1D" or not hasattr(ch, "nf"):
+                continue
+            w = ch.weight.detach()
+            lin = torch.nn.Linear(w.shape[0], w.shape[1], bias=ch.bias is not None)
+            lin.weight = torch.nn.Parameter(w.t().contiguous(), requires_grad=False)
+            if ch.bias is not None:
+                lin.bias = torch.nn.Parameter(ch.bias.detach().clone(), requires_grad=False)
+            setattr(mod, name, lin)
+            n += 1
+    return n
+
+def prepare_model(m, mode: str = "fp32", threads: int = 0, interop: int = 0) -> Dict:
+    """
+    Готовит XTTS к инференсу на CPU. mode="fast": Conv1D GPT -> Linear, динамическое
+    int8-квантование Linear в GPT и декодере (кроме speaker encoder — эмбеддинг эталона
+    остаётся как в fp32), блоки под torch.inference_mode. Возвращает сводку для MODEL_STATE.
+    """
+    info: Dict = dict(mode=mode)
+    if mode == "fp32" and not threads and not interop:
+        return info
+    info["threads"], info["interop_threads"] = set_threads(threads, interop)
+    if mode != "fast" or not hasattr(m, "gpt"):
+        return info
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+
+    m.eval()
+    info["conv1d_replaced"] = _conv1d_to_linear(m.gpt)
+    before = sum(isinstance(x, torch.nn.Linear) for x in m.modules())
+    quantize_dynamic(m.gpt, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    dec = getattr(m, "hifigan_decoder", None)
+    if dec is not None:
+        names = {n for n, x in dec.named_modules()
+                 if isinstance(x, torch.nn.Linear) and not n.startswith("speaker_encoder")}
+        if names:
+            quantize_dynamic(dec, names, dtype=torch.qint8, inplace=True)
+    info["quantized_linear"] = before - sum(isinstance(x, torch.nn.Linear) for x in m.modules())
+    m._t2v_fast = True
+    return info
+
+
+# ---- дочерний процесс ----
+def _init(model_name: str, gpu: bool, threads: int, mode: str = "fp32"):
+    set_threads(max(1, threads), 1)
+    from TTS.api import TTS
+    global _MODEL, _PREPARED
+    _MODEL = TTS(model_name=model_name, gpu=gpu)
+    _PREPARED = prepare_model(_MODEL.synthesizer.tts_model, mode)
+
+def _latents(voice_wav: str, key: str, latent_path: str):
+    import torch
+
+    hit = _LATENTS.get(key)
+    if hit is not None:
+        return hit, "mem"
+    src = "disk"
+    try:
+        d = torch.load(latent_path, map_location="cpu")
+        lat = (d["gpt"], d["spk"])
+    except Exception:
+        src = "miss"
+        lat = xtts_latents(_MODEL.synthesizer.tts_model, Path(voice_wav))
+        try:
+            tmp = latent_path + f".{os.getpid()}.tmp"
+            torch.save({"gpt": lat[0], "spk": lat[1]}, tmp)
+            os.replace(tmp, latent_path)
+        except Exception:
+            pass
+    if len(_LATENTS) >= _LATENT_ITEMS:
+        _LATENTS.pop(next(iter(_LATENTS)))
+    _LATENTS[key] = lat
+    return lat, src
+
+def _synth(text: str, lang: str, voice_wav: str, key: str, latent_path: str):
+    t0 = time.time()
+    (gpt, spk), src = _latents(voice_wav, key, latent_path)
+    a = np.ascontiguousarray(xtts_infer(_MODEL.synthesizer.tts_model, text, lang, gpt, spk), dtype=np.float32)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, a.nbytes))
+    np.ndarray(a.shape, np.float32, buffer=shm.buf)[:] = a
+    try:
+        # освобождает родитель (unlink), трекер ребёнка не должен его удалять
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    shm.close()
+    return shm.name, int(a.size), int(_MODEL.synthesizer.output_sample_rate), time.time() - t0, src
+
+def _model_bytes() -> int:
+    return model_bytes(_MODEL.synthesizer.tts_model)
+
+def _prepared() -> Optional[Dict]:
+    return _PREPARED
+
+
+# ---- родитель ----
+def take_shared(res) -> Tuple[np.ndarray, int, float, str]:
+    """
+    Копирует аудио из shared memory и освобождает сегмент: (audio, sr, sec, latent_src).
+    """
+    name, n, sr, sec, src = res
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        a = np.ndarray((n,), np.float32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return a, sr, sec, src
+
+class XttsPool:
+    """
+    N процессов-реплик; submit() отдаёт блок первому свободному.
+    """
+    def __init__(self, size: int, model_name: str, gpu: bool = False, threads: int = 0, mode: str = "fp32"):
+        self.size = max(1, size)
+        self.threads = threads or max(1, (os.cpu_count() or 1) // self.size)
+        self._ex = ProcessPoolExecutor(
+            max_workers=self.size,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init,
+            initargs=(model_name, gpu, self.threads, mode),
+        )
+
+    def submit(self, text: str, lang: str, voice_wav: Path, key: str, latent_path: Path) -> Future:
+        return self._ex.submit(_synth, text, lang, str(voice_wav), key, str(latent_path))
+
+    def model_bytes(self) -> int:
+        # реплики одинаковые: одна на всех, умноженная на число процессов
+        return self._ex.submit(_model_bytes).result() * self.size
+
+    def prepared(self) -> Optional[Dict]:
+        return self._ex.submit(_prepared).result()
+
+    def shutdown(self):
+        self._ex.shutdown(wait=False, cancel_futures=True)